@@ -2,8 +2,14 @@
 SciBox LLM API Configuration and Client
 """
 import os
-from typing import Optional, Dict, Any, List
-import requests
+import re
+import atexit
+import copy
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Set, Tuple, AsyncIterator
+import httpx
+import orjson
 from datetime import datetime
 import time
 from queue import Queue
@@ -12,6 +18,82 @@ import asyncio
 from dotenv import load_dotenv
 
 
+# Optional ```json ... ``` fence around LLM JSON answers
+_CODE_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$", re.DOTALL)
+
+
+_ORIGINALITY_PROMPT = """Проанализируй следующий код на признаки того, что он может быть скопирован из внешнего источника (GitHub, Stack Overflow, онлайн-репозиториев).
+
+Код:
+```python
+{code}
+```
+
+Задача: {task}
+
+Верни JSON с полями:
+- originality_score: число от 0 до 100 (100 = полностью оригинальный)
+- suspicious_patterns: список строк с подозрительными паттернами (может быть пустым)
+- explanation: объяснение оценки
+
+Отвечай ТОЛЬКО валидным JSON, без дополнительного текста."""
+
+_PROCTOR_PROMPT = """Проанализируй следующую историю событий прокторинга и определи, есть ли признаки читерства:
+
+События:
+{events}
+
+Задача: {task}
+Время решения: {elapsed} минут
+Уровень кандидата: {level}
+
+Верни JSON с полями:
+- risk_score: число от 0 до 100 (риск читерства, 0 = нет риска, 100 = точно читерство)
+- flagged_events: список типов событий, которые подозрительны
+- reasoning: объяснение оценки на русском языке
+- recommendation: одно из значений: "pass" (все ок), "watch" (наблюдать), "fail" (подозрение в читерстве)
+
+Отвечай ТОЛЬКО валидным JSON, без дополнительного текста."""
+
+
+def _parse_llm_json(response_text: str) -> Any:
+    """Parse JSON from an LLM answer, stripping a markdown code fence if present"""
+    match = _CODE_FENCE_RE.match(response_text)
+    return orjson.loads(match.group(1) if match else response_text)
+
+
+class _JsonObjectTracker:
+    """Tracks brace depth over streamed text to detect when the first JSON object closes"""
+    
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+    
+    def feed(self, chunk: str) -> int:
+        """Consume chunk; return index just past the closing brace, or -1"""
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.started:
+                    self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return -1
+
+
 class SciBoxConfig:
     """Configuration for SciBox LLM API"""
     
@@ -70,40 +152,122 @@ class RateLimiter:
     def __init__(self, rps: int):
         self.rps = rps
         self.min_interval = 1.0 / rps  # Minimum interval between requests
-        self.last_request_time = {}
+        self._next_slot = time.monotonic()
         self.lock = threading.Lock()
     
+    def _reserve_slot(self) -> float:
+        """Reserve the next request slot and return how long to wait for it"""
+        # Lock only guards the reservation; sleeping happens outside of it,
+        # so waiters don't serialize behind each other's sleep
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+        return slot - now
+    
     def wait_if_needed(self, model: str):
         """Wait if necessary to respect rate limit"""
-        with self.lock:
-            current_time = time.time()
-            last_time = self.last_request_time.get(model, 0)
-            elapsed = current_time - last_time
-            
-            if elapsed < self.min_interval:
-                sleep_time = self.min_interval - elapsed
-                time.sleep(sleep_time)
-            
-            self.last_request_time[model] = time.time()
+        wait = self._reserve_slot()
+        if wait > 0:
+            time.sleep(wait)
+    
+    async def await_if_needed(self, model: str):
+        """Async variant of wait_if_needed that doesn't block the event loop"""
+        wait = self._reserve_slot()
+        if wait > 0:
+            await asyncio.sleep(wait)
 
 
 class SciBoxClient:
     """Client for SciBox LLM API with rate limiting"""
     
+    # Concurrent async embedding requests are coalesced into one POST
+    EMBEDDING_BATCH_SIZE = 16
+    EMBEDDING_BATCH_WINDOW = 0.02  # seconds
+    
+    # LRU cache of originality verdicts (resubmits of the same code are common)
+    ORIGINALITY_CACHE_SIZE = 4096
+    ORIGINALITY_CACHE_TTL = 600  # seconds
+    
+    # LRU cache of async chat responses keyed by the full request payload.
+    # Only near-deterministic calls are cached: creative prompts (new tasks,
+    # questions) must still vary between calls.
+    CHAT_CACHE_SIZE = 1024
+    CHAT_CACHE_TTL = 600  # seconds
+    CHAT_CACHE_MAX_TEMPERATURE = 0.5
+    
     def __init__(self, config: Optional[SciBoxConfig] = None):
         self.config = config or SciBoxConfig()
         self.rate_limiters = {
             model_name: RateLimiter(model_config["rps"])
             for model_name, model_config in self.config.models.items()
         }
-        self.session = requests.Session()
-        self.session.headers.update(self.config.headers)
+        # LLM ответы бывают долгими, установка соединения - нет
+        self._timeout = httpx.Timeout(60.0, connect=5.0)
+        self._limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        self.session = httpx.Client(
+            http2=True,
+            headers=self.config.headers,
+            timeout=self._timeout,
+            limits=self._limits,
+        )
+        # Async клиент создается лениво, уже внутри работающего event loop
+        self._async_session: Optional[httpx.AsyncClient] = None
+        self._embedding_queue: List[Tuple[str, asyncio.Future]] = []
+        self._embedding_flush_handle: Optional[asyncio.TimerHandle] = None
+        # The loop only holds weak references to tasks - keep in-flight batches alive
+        self._embedding_batch_tasks: Set[asyncio.Task] = set()
+        self._originality_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._originality_cache_lock = threading.Lock()
+        self._chat_cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+    
+    @property
+    def async_session(self) -> httpx.AsyncClient:
+        """Native async client: async_* methods don't push requests through a thread"""
+        if self._async_session is None or self._async_session.is_closed:
+            self._async_session = httpx.AsyncClient(
+                http2=True,
+                headers=self.config.headers,
+                timeout=self._timeout,
+                limits=self._limits,
+            )
+        return self._async_session
+    
+    def close(self) -> None:
+        """Close the synchronous HTTP client"""
+        self.session.close()
+    
+    async def aclose(self) -> None:
+        """Close the async HTTP client; call from the application's shutdown.
+        
+        The sync client stays open for the next startup in the same process
+        and is released by the atexit hook.
+        """
+        if self._async_session is not None:
+            await self._async_session.aclose()
+            self._async_session = None
     
     def list_models(self) -> List[Dict[str, Any]]:
         """Get list of available models"""
         response = self.session.get(self.config.get_models_url())
         response.raise_for_status()
-        return response.json().get("data", [])
+        return orjson.loads(response.content).get("data", [])
+    
+    async def warm_up(self) -> None:
+        """
+        Open the HTTP/2 connections to SciBox ahead of the first real request
+        
+        The sync client (behavior/originality analysis) and the async client
+        each hold their own pool, so both get one cheap GET /models; the TLS
+        handshake is then already paid when a user-facing call arrives.
+        Failures are ignored - the first request simply connects itself.
+        """
+        models_url = self.config.get_models_url()
+        await asyncio.gather(
+            asyncio.to_thread(self.session.get, models_url),
+            self.async_session.get(models_url),
+            return_exceptions=True
+        )
     
     def generate_embedding(
         self, 
@@ -120,31 +284,68 @@ class SciBoxClient:
         Returns:
             List of embedding values
         """
-        if model != "bge-m3":
-            raise ValueError(f"Embeddings only supported with bge-m3 model, got {model}")
-        
+        payload = self._embeddings_payload(text, model)
         self.rate_limiters["bge-m3"].wait_if_needed("bge-m3")
         
-        payload = {
-            "model": self.config.models["bge-m3"]["name"],
-            "input": text
-        }
-        
         response = self.session.post(
             self.config.get_embeddings_url(),
             json=payload
         )
         response.raise_for_status()
         
-        data = response.json()
+        data = orjson.loads(response.content)
         return data["data"][0]["embedding"]
     
+    def generate_embeddings(
+        self,
+        texts: List[str],
+        model: str = "bge-m3"
+    ) -> List[List[float]]:
+        """
+        Generate embeddings for several texts in a single request
+        
+        Args:
+            texts: Input texts to embed
+            model: Model name (default: bge-m3)
+            
+        Returns:
+            List of embeddings in the same order as texts
+        """
+        payload = self._embeddings_payload(texts, model)
+        self.rate_limiters["bge-m3"].wait_if_needed("bge-m3")
+        
+        response = self.session.post(
+            self.config.get_embeddings_url(),
+            json=payload
+        )
+        response.raise_for_status()
+        
+        return self._parse_embeddings(response.content, len(texts))
+    
+    def _embeddings_payload(self, input_data: Any, model: str) -> Dict[str, Any]:
+        if model != "bge-m3":
+            raise ValueError(f"Embeddings only supported with bge-m3 model, got {model}")
+        
+        return {
+            "model": self.config.models["bge-m3"]["name"],
+            "input": input_data
+        }
+    
+    @staticmethod
+    def _parse_embeddings(content: bytes, expected: int) -> List[List[float]]:
+        data = orjson.loads(content)["data"]
+        data.sort(key=lambda item: item.get("index", 0))
+        if len(data) != expected:
+            raise ValueError(f"Expected {expected} embeddings, got {len(data)}")
+        return [item["embedding"] for item in data]
+    
     def chat_completion(
         self,
         messages: List[Dict[str, str]],
         model: str = "qwen3-awq",
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
+        stream: bool = False,
         **kwargs
     ) -> str:
         """
@@ -155,13 +356,72 @@ class SciBoxClient:
             model: Model name (qwen3-coder or qwen3-awq)
             temperature: Sampling temperature
             max_tokens: Maximum tokens to generate
+            stream: Stream the answer and stop as soon as the first
+                JSON object in it is complete (for JSON-only prompts)
             
         Returns:
             Generated text response
         """
-        model_key = "qwen3-coder" if "coder" in model.lower() else "qwen3-awq"
+        model_key, payload = self._chat_payload(
+            messages, model, temperature, max_tokens, **kwargs
+        )
         self.rate_limiters[model_key].wait_if_needed(model_key)
         
+        if stream:
+            return self._stream_until_json_closed(payload)
+        
+        response = self.session.post(
+            self.config.get_chat_url(),
+            json=payload
+        )
+        response.raise_for_status()
+        
+        data = orjson.loads(response.content)
+        return data["choices"][0]["message"]["content"]
+    
+    def _stream_until_json_closed(self, payload: Dict[str, Any]) -> str:
+        """Read an SSE chat stream, closing the connection once the JSON answer is complete"""
+        parts: List[str] = []
+        tracker = _JsonObjectTracker()
+        
+        with self.session.stream(
+            "POST",
+            self.config.get_chat_url(),
+            json={**payload, "stream": True}
+        ) as response:
+            response.raise_for_status()
+            
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                
+                choices = orjson.loads(data).get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if not content:
+                    continue
+                
+                end = tracker.feed(content)
+                if end >= 0:
+                    # Leaving the with-block closes the stream - no need
+                    # to wait for the model to finish generating
+                    parts.append(content[:end])
+                    break
+                parts.append(content)
+        
+        return "".join(parts)
+    
+    def _chat_payload(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        **kwargs
+    ) -> Tuple[str, Dict[str, Any]]:
+        model_key = "qwen3-coder" if "coder" in model.lower() else "qwen3-awq"
         model_name = self.config.models[model_key]["name"]
         
         payload = {
@@ -174,46 +434,169 @@ class SciBoxClient:
         if max_tokens:
             payload["max_tokens"] = max_tokens
         
-        response = self.session.post(
+        return model_key, payload
+
+    # --- Async API (native httpx.AsyncClient) ---
+    async def async_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str = "qwen3-awq",
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        **kwargs
+    ) -> str:
+        model_key, payload = self._chat_payload(
+            messages, model, temperature, max_tokens, **kwargs
+        )
+        cache_key = None
+        if temperature <= self.CHAT_CACHE_MAX_TEMPERATURE:
+            cache_key = hashlib.blake2b(
+                orjson.dumps(payload, option=orjson.OPT_SORT_KEYS),
+                digest_size=16
+            ).digest()
+            cached = self._chat_cache.get(cache_key)
+            if cached is not None:
+                inserted_at, content = cached
+                if time.monotonic() - inserted_at < self.CHAT_CACHE_TTL:
+                    self._chat_cache.move_to_end(cache_key)
+                    return content
+                del self._chat_cache[cache_key]
+        
+        await self.rate_limiters[model_key].await_if_needed(model_key)
+        
+        response = await self.async_session.post(
             self.config.get_chat_url(),
             json=payload
         )
         response.raise_for_status()
         
-        data = response.json()
-        return data["choices"][0]["message"]["content"]
+        data = orjson.loads(response.content)
+        content = data["choices"][0]["message"]["content"]
+        
+        if cache_key is not None:
+            self._chat_cache[cache_key] = (time.monotonic(), content)
+            if len(self._chat_cache) > self.CHAT_CACHE_SIZE:
+                self._chat_cache.popitem(last=False)
+        
+        return content
 
-    # --- Async convenience wrappers (run sync client in thread) ---
-    async def async_chat_completion(
+    async def async_chat_completion_stream(
         self,
         messages: List[Dict[str, str]],
         model: str = "qwen3-awq",
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
         **kwargs
-    ) -> str:
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            lambda: self.chat_completion(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                **kwargs,
-            ),
+    ) -> AsyncIterator[str]:
+        """
+        Stream a chat completion as content deltas
+        
+        Like chat_completion(stream=True), the stream ends as soon as the
+        first JSON object in the answer is complete. Lets callers act on
+        leading fields of the JSON before the model finishes generating.
+        """
+        model_key, payload = self._chat_payload(
+            messages, model, temperature, max_tokens, **kwargs
         )
+        await self.rate_limiters[model_key].await_if_needed(model_key)
+        
+        tracker = _JsonObjectTracker()
+        
+        async with self.async_session.stream(
+            "POST",
+            self.config.get_chat_url(),
+            json={**payload, "stream": True}
+        ) as response:
+            response.raise_for_status()
+            
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                
+                choices = orjson.loads(data).get("choices") or [{}]
+                content = (choices[0].get("delta") or {}).get("content")
+                if not content:
+                    continue
+                
+                end = tracker.feed(content)
+                if end >= 0:
+                    yield content[:end]
+                    break
+                yield content
 
     async def async_generate_embedding(
         self,
         text: str,
         model: str = "bge-m3",
     ) -> List[float]:
+        if model != "bge-m3":
+            raise ValueError(f"Embeddings only supported with bge-m3 model, got {model}")
+        
+        # Requests arriving within EMBEDDING_BATCH_WINDOW share one POST
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            lambda: self.generate_embedding(text, model=model),
+        future = loop.create_future()
+        self._embedding_queue.append((text, future))
+        
+        if len(self._embedding_queue) >= self.EMBEDDING_BATCH_SIZE:
+            self._flush_embedding_queue()
+        elif self._embedding_flush_handle is None:
+            self._embedding_flush_handle = loop.call_later(
+                self.EMBEDDING_BATCH_WINDOW,
+                self._flush_embedding_queue,
+            )
+        
+        return await future
+
+    def _flush_embedding_queue(self) -> None:
+        if self._embedding_flush_handle is not None:
+            self._embedding_flush_handle.cancel()
+            self._embedding_flush_handle = None
+        
+        batch, self._embedding_queue = self._embedding_queue, []
+        if batch:
+            task = asyncio.ensure_future(self._run_embedding_batch(batch))
+            self._embedding_batch_tasks.add(task)
+            task.add_done_callback(self._embedding_batch_tasks.discard)
+
+    async def _run_embedding_batch(
+        self,
+        batch: List[Tuple[str, asyncio.Future]],
+    ) -> None:
+        texts = [text for text, _ in batch]
+        
+        try:
+            embeddings = await self._async_post_embeddings(texts)
+        except Exception:
+            # Endpoint may not accept array input - fall back to one request per text
+            for text, future in batch:
+                try:
+                    embedding = (await self._async_post_embeddings([text]))[0]
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(embedding)
+            return
+        
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _async_post_embeddings(self, texts: List[str]) -> List[List[float]]:
+        payload = self._embeddings_payload(texts, "bge-m3")
+        await self.rate_limiters["bge-m3"].await_if_needed("bge-m3")
+        
+        response = await self.async_session.post(
+            self.config.get_embeddings_url(),
+            json=payload
         )
+        response.raise_for_status()
+        
+        return self._parse_embeddings(response.content, len(texts))
 
     # Backwards-compatible alias used by interviewer modules
     def create_embedding(self, input_text: str, model: str = "bge-m3") -> List[float]:
@@ -234,21 +617,22 @@ class SciBoxClient:
         Returns:
             Dictionary with originality_score, suspicious_patterns, explanation
         """
-        prompt = f"""Проанализируй следующий код на признаки того, что он может быть скопирован из внешнего источника (GitHub, Stack Overflow, онлайн-репозиториев).
-
-Код:
-```python
-{code}
-```
-
-Задача: {task_description}
-
-Верни JSON с полями:
-- originality_score: число от 0 до 100 (100 = полностью оригинальный)
-- suspicious_patterns: список строк с подозрительными паттернами (может быть пустым)
-- explanation: объяснение оценки
-
-Отвечай ТОЛЬКО валидным JSON, без дополнительного текста."""
+        cache_key = hashlib.blake2b(
+            f"{task_description}\0{code}".encode("utf-8"),
+            digest_size=16
+        ).hexdigest()
+        
+        with self._originality_cache_lock:
+            cached = self._originality_cache.get(cache_key)
+            if cached is not None:
+                inserted_at, verdict = cached
+                if time.monotonic() - inserted_at < self.ORIGINALITY_CACHE_TTL:
+                    self._originality_cache.move_to_end(cache_key)
+                    # Callers append to suspicious_patterns - never hand out the cached dict
+                    return copy.deepcopy(verdict)
+                del self._originality_cache[cache_key]
+        
+        prompt = _ORIGINALITY_PROMPT.format_map({"code": code, "task": task_description})
         
         messages = [
             {"role": "system", "content": "Ты - эксперт по анализу кода на оригинальность. Ты всегда отвечаешь валидным JSON."},
@@ -259,28 +643,24 @@ class SciBoxClient:
             response_text = self.chat_completion(
                 messages=messages,
                 model="qwen3-coder",
-                temperature=0.3
+                temperature=0.3,
+                stream=True
             )
             
-            # Parse JSON from response
-            import json
-            # Try to extract JSON from response (might have markdown code blocks)
-            response_text = response_text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-            
-            return json.loads(response_text)
+            verdict = _parse_llm_json(response_text)
         except Exception as e:
             return {
                 "originality_score": 50,
                 "suspicious_patterns": [f"Ошибка анализа: {str(e)}"],
                 "explanation": "Не удалось проанализировать код"
             }
+        
+        with self._originality_cache_lock:
+            self._originality_cache[cache_key] = (time.monotonic(), verdict)
+            if len(self._originality_cache) > self.ORIGINALITY_CACHE_SIZE:
+                self._originality_cache.popitem(last=False)
+        
+        return copy.deepcopy(verdict)
     
     def analyze_proctoring_behavior(
         self,
@@ -301,24 +681,13 @@ class SciBoxClient:
         Returns:
             Dictionary with risk_score, flagged_events, reasoning, recommendation
         """
-        import json
-        
-        prompt = f"""Проанализируй следующую историю событий прокторинга и определи, есть ли признаки читерства:
-
-События:
-{json.dumps(events, indent=2, ensure_ascii=False)}
-
-Задача: {task_description}
-Время решения: {elapsed_time} минут
-Уровень кандидата: {candidate_level}
-
-Верни JSON с полями:
-- risk_score: число от 0 до 100 (риск читерства, 0 = нет риска, 100 = точно читерство)
-- flagged_events: список типов событий, которые подозрительны
-- reasoning: объяснение оценки на русском языке
-- recommendation: одно из значений: "pass" (все ок), "watch" (наблюдать), "fail" (подозрение в читерстве)
-
-Отвечай ТОЛЬКО валидным JSON, без дополнительного текста."""
+        events_json = orjson.dumps(events, option=orjson.OPT_INDENT_2).decode()
+        prompt = _PROCTOR_PROMPT.format_map({
+            "events": events_json,
+            "task": task_description,
+            "elapsed": elapsed_time,
+            "level": candidate_level
+        })
         
         messages = [
             {"role": "system", "content": "Ты - эксперт по детектированию читерства на технических собеседованиях. Ты всегда отвечаешь валидным JSON."},
@@ -330,20 +699,11 @@ class SciBoxClient:
                 messages=messages,
                 model="qwen3-awq",
                 temperature=0.3,
-                max_tokens=1000
+                max_tokens=1000,
+                stream=True
             )
             
-            # Parse JSON from response
-            response_text = response_text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-            
-            return json.loads(response_text)
+            return _parse_llm_json(response_text)
         except Exception as e:
             return {
                 "risk_score": 50,
@@ -355,12 +715,24 @@ class SciBoxClient:
 
 # Singleton instance
 _client_instance: Optional[SciBoxClient] = None
+_client_lock = threading.Lock()
+
+
+def _close_client_instance() -> None:
+    """Release pooled sockets of the singleton at interpreter exit"""
+    if _client_instance is not None:
+        _client_instance.close()
+
+
+atexit.register(_close_client_instance)
 
 
 def get_scibox_client() -> SciBoxClient:
     """Get singleton SciBox client instance"""
     global _client_instance
     if _client_instance is None:
-        _client_instance = SciBoxClient()
+        with _client_lock:
+            if _client_instance is None:
+                _client_instance = SciBoxClient()
     return _client_instance
 
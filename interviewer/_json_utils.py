@@ -0,0 +1,111 @@
+"""
+Извлечение JSON из ответов LLM (общий хелпер для модулей интервьюера)
+"""
+from typing import Any, Dict, Optional, Tuple
+import orjson
+
+
+def _find_json_span(text: str) -> Optional[Tuple[int, int]]:
+    """
+    Границы первого сбалансированного JSON объекта/массива в тексте
+    
+    Один проход по символам: считаем глубину по { и [, внутри строковых
+    литералов скобки игнорируются (с учетом экранирования).
+    """
+    depth = 0
+    start = -1
+    in_string = False
+    escape = False
+    
+    for i, ch in enumerate(text):
+        if start == -1:
+            if ch == "{" or ch == "[":
+                start = i
+                depth = 1
+            continue
+        
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{" or ch == "[":
+            depth += 1
+        elif ch == "}" or ch == "]":
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    
+    return None
+
+
+def extract_json_from_text(text: str) -> Any:
+    """
+    Извлечение JSON из текста LLM (может быть обернут в markdown)
+    
+    Returns:
+        Распарсенный JSON или {} если ничего не нашлось
+    """
+    # Попытка 1: прямой парсинг
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        pass
+    
+    # Попытка 2: первый сбалансированный JSON объект/массив
+    span = _find_json_span(text)
+    if span:
+        try:
+            return orjson.loads(text[span[0]:span[1]])
+        except ValueError:
+            pass
+    
+    # Попытка 3: содержимое markdown блока
+    fence_start = text.find("```")
+    fence_end = text.rfind("```")
+    if fence_start != -1 and fence_end > fence_start:
+        body = text[fence_start + 3:fence_end]
+        if body.startswith("json"):
+            body = body[4:]
+        try:
+            return orjson.loads(body)
+        except ValueError:
+            pass
+    
+    return {}
+
+
+def parse_json_prefix(text: str, key: str) -> Optional[Dict[str, Any]]:
+    """
+    Разбор начала JSON объекта, который еще дописывается (стриминг)
+    
+    Если в тексте уже есть поле key и его значение (объект/массив)
+    закрылось, возвращает объект из всех полей до key включительно.
+    
+    Returns:
+        dict с полями до key или None если значение еще не дописано
+    """
+    obj_start = text.find("{")
+    key_pos = text.find(f'"{key}"', obj_start + 1)
+    if obj_start == -1 or key_pos == -1:
+        return None
+    
+    span = _find_json_span(text[key_pos:])
+    if not span:
+        return None
+    
+    try:
+        prefix = orjson.loads(text[obj_start:key_pos + span[1]] + "}")
+    except ValueError:
+        return None
+    
+    return prefix if isinstance(prefix, dict) else None
+
+
+def dumps_json(value: Any) -> str:
+    """Компактная сериализация для вставки данных в промпт (без отступов - меньше токенов)"""
+    return orjson.dumps(value).decode()
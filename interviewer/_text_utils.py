@@ -0,0 +1,30 @@
+"""
+Ограничение текста для промптов по приблизительному числу токенов
+"""
+
+
+# Распространенная оценка: ~4 байта UTF-8 на токен (латиница ~4 символа,
+# кириллица ~2 символа на токен)
+BYTES_PER_TOKEN = 4
+
+
+def approx_tokens(text: str) -> int:
+    """Приблизительное число токенов в тексте"""
+    return len(text.encode("utf-8")) // BYTES_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Обрезать текст примерно до max_tokens токенов
+    
+    Режется по байтам UTF-8, неполный последний символ отбрасывается.
+    """
+    max_bytes = max_tokens * BYTES_PER_TOKEN
+    # Символ UTF-8 не длиннее 4 байт - заведомо короткий текст не кодируем
+    if len(text) * 4 <= max_bytes:
+        return text
+    
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode("utf-8", errors="ignore")
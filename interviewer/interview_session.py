@@ -2,15 +2,50 @@
 Interview Session - Управление полным циклом интервью
 """
 from typing import Dict, Any, List, Optional
+from collections import OrderedDict
 from datetime import datetime
+import asyncio
+import os
+import pickle
+import sqlite3
+import time
 import uuid
 
 from .resume_analyzer import ResumeAnalyzer
 from .task_generator import TaskGenerator
 from .solution_checker import SolutionChecker
+from ._json_utils import extract_json_from_text
 from config.scibox import SciBoxClient
 
 
+# Статичная часть промпта финального отчета - общий префикс для всех интервью
+_FINAL_REPORT_SYSTEM = """Проанализируй интервью кандидата из сообщения пользователя и дай рекомендацию.
+
+Дай финальный вердикт в JSON:
+{
+  "decision": "hire" или "reject" или "maybe",
+  "confidence": 85,
+  "summary": "Краткое резюме на 2-3 предложения",
+  "strengths": ["Сильная сторона 1", "Сильная сторона 2"],
+  "weaknesses": ["Слабая сторона 1", "Слабая сторона 2"],
+  "recommendations": ["Рекомендация 1", "Рекомендация 2"],
+  "fit_for_level": "Middle"
+}"""
+
+# Шаблоны пользовательской части отчета (результаты задач вставляются между ними)
+_FINAL_REPORT_HEADER = """Позиция: {job_position}
+Уровень кандидата: {level}
+Опыт: {experience} лет
+Навыки: {skills}
+
+Результаты задач:
+"""
+
+_FINAL_REPORT_FOOTER = """
+Средний балл: {average_score:.0f}/100
+Успешно решено: {passed}/{total}"""
+
+
 class InterviewSession:
     """
     Полный цикл автоматизированного интервью
@@ -24,13 +59,18 @@ class InterviewSession:
     6. Финальный отчет → hire/reject с обоснованием
     """
     
-    def __init__(self, scibox_client: SciBoxClient):
+    # Сколько сессий держим в памяти; завершенные сверх лимита уходят в sqlite
+    MAX_LIVE_SESSIONS = 1024
+    
+    def __init__(self, scibox_client: SciBoxClient, spill_path: Optional[str] = None):
         self.client = scibox_client
         self.resume_analyzer = ResumeAnalyzer(scibox_client)
         self.task_generator = TaskGenerator(scibox_client)
         self.solution_checker = SolutionChecker(scibox_client)
         
-        self.sessions: Dict[str, Dict[str, Any]] = {}  # session_id -> session_data
+        self.sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # session_id -> session_data
+        self._spill_path = spill_path or os.getenv("INTERVIEW_SESSIONS_SPILL", "interview_sessions.sqlite3")
+        self._spill_db: Optional[sqlite3.Connection] = None
     
     async def start_interview(
         self,
@@ -57,30 +97,65 @@ class InterviewSession:
         """
         session_id = str(uuid.uuid4())
         
+        # Первую задачу генерируем спекулятивно: как только в стриме анализа
+        # резюме готовы уровень и топ-3 навыка, параллельно с генерацией вопросов
+        speculative: Dict[str, Any] = {}
+        
+        def start_first_task(profile: Dict[str, Any]):
+            print(f"[Session {session_id}] Generating first task...")
+            speculative["profile"] = profile
+            speculative["task"] = asyncio.create_task(
+                self.task_generator.generate_task(
+                    candidate_level=profile["candidate_level"],
+                    focus_skills=profile["focus_skills"],
+                    task_number=1,
+                    resume_context=profile["parsed_data"]
+                )
+            )
+        
         # 1. Анализ резюме
         print(f"[Session {session_id}] Analyzing resume...")
-        resume_analysis = await self.resume_analyzer.analyze_resume(
-            resume_text,
-            job_position
-        )
-        
-        # 2. Стратегия интервью
-        strategy = await self.resume_analyzer.get_interview_strategy(
-            resume_analysis,
-            interview_type="technical"
-        )
+        try:
+            resume_analysis = await self.resume_analyzer.analyze_resume(
+                resume_text,
+                job_position,
+                on_profile=start_first_task
+            )
+            
+            # 2. Стратегия интервью
+            strategy = self.resume_analyzer.get_interview_strategy(
+                resume_analysis,
+                interview_type="technical"
+            )
+        except BaseException:
+            if "task" in speculative:
+                speculative["task"].cancel()
+            raise
         
-        # 3. Генерация первой задачи
-        print(f"[Session {session_id}] Generating first task...")
-        first_task = await self.task_generator.generate_task(
-            candidate_level=strategy["start_level"],
-            focus_skills=strategy["focus_areas"],
-            task_number=1,
-            resume_context=resume_analysis
-        )
+        # 3. Первая задача: спекулятивная подходит, если совпали и уровень, и
+        # фокус (при запасных путях анализа навыки могут разойтись). Из
+        # resume_context промпт берет только projects, а они в анализе те же,
+        # что в распарсенном резюме
+        speculative_task = speculative.get("task")
+        profile = speculative.get("profile")
+        if (speculative_task is not None
+                and strategy["start_level"] == profile["candidate_level"]
+                and strategy["focus_areas"] == profile["focus_skills"]):
+            first_task = await speculative_task
+        else:
+            if speculative_task is not None:
+                speculative_task.cancel()
+            else:
+                print(f"[Session {session_id}] Generating first task...")
+            first_task = await self.task_generator.generate_task(
+                candidate_level=strategy["start_level"],
+                focus_skills=strategy["focus_areas"],
+                task_number=1,
+                resume_context=resume_analysis
+            )
         
         # 4. Сохранение сессии
-        self.sessions[session_id] = {
+        self._store_session(session_id, {
             "session_id": session_id,
             "job_position": job_position,
             "resume_analysis": resume_analysis,
@@ -89,11 +164,16 @@ class InterviewSession:
             "tasks": [first_task],
             "solutions": [],
             "scores": [],
+            # Агрегаты обновляются при каждом submit, чтобы не пересчитывать по спискам
+            "score_sum": 0.0,
+            "score_count": 0,
+            "total_time": 0,
             "num_tasks": num_tasks,
             "current_task_index": 0,
             "status": "in_progress",
-            "started_at": datetime.utcnow().isoformat()
-        }
+            "started_at": datetime.utcnow().isoformat(),
+            "started_at_ts": time.time()
+        })
         
         return {
             "session_id": session_id,
@@ -132,20 +212,45 @@ class InterviewSession:
                 "current_progress": {...}
             }
         """
-        session = self.sessions.get(session_id)
+        session = self._get_session(session_id)
         if not session:
             raise ValueError(f"Session {session_id} not found")
         
         current_task = session["tasks"][session["current_task_index"]]
+        next_task_number = session["current_task_index"] + 2
+        
+        # Следующая задача зависит от оценки только через уровень сложности,
+        # поэтому генерируем ее спекулятивно по доле пройденных тестов
+        speculative_task = None
+        speculative_level = None
+        if next_task_number <= session["num_tasks"]:
+            speculative_performance = {
+                "score": self._estimate_score(current_task, test_results),
+                "time": time_spent,
+                "errors": test_results.get("failed_tests", 0)
+            }
+            speculative_level = self.task_generator.next_level(
+                session["current_level"],
+                speculative_performance
+            )
+            print(f"[Session {session_id}] Generating next task (adaptive)...")
+            speculative_task = asyncio.create_task(
+                self._generate_next_task(session, next_task_number, speculative_performance)
+            )
         
         # 1. Проверка решения
         print(f"[Session {session_id}] Checking solution for task {session['current_task_index'] + 1}...")
-        evaluation = await self.solution_checker.check_solution(
-            task=current_task,
-            candidate_solution=solution_code,
-            test_results=test_results,
-            candidate_level=session["current_level"]
-        )
+        try:
+            evaluation = await self.solution_checker.check_solution(
+                task=current_task,
+                candidate_solution=solution_code,
+                test_results=test_results,
+                candidate_level=session["current_level"]
+            )
+        except BaseException:
+            if speculative_task:
+                speculative_task.cancel()
+            raise
         
         # 2. Сохранение результата
         session["solutions"].append({
@@ -156,6 +261,9 @@ class InterviewSession:
             "submitted_at": datetime.utcnow().isoformat()
         })
         session["scores"].append(evaluation["score"])
+        session["score_sum"] += evaluation["score"]
+        session["score_count"] += 1
+        session["total_time"] += time_spent
         
         # 3. Проверка завершения интервью
         session["current_task_index"] += 1
@@ -164,27 +272,33 @@ class InterviewSession:
         if interview_complete:
             session["status"] = "completed"
             session["completed_at"] = datetime.utcnow().isoformat()
+            session["completed_at_ts"] = time.time()
+            final_report = await self.generate_final_report(session_id)
+            
+            # Завершенная сессия теперь может быть выгружена из памяти
+            self._evict_sessions()
             
             return {
                 "evaluation": evaluation,
                 "next_task": None,
                 "interview_complete": True,
-                "final_report": await self.generate_final_report(session_id)
+                "final_report": final_report
             }
         
-        # 4. Генерация следующей задачи (адаптивная)
-        print(f"[Session {session_id}] Generating next task (adaptive)...")
-        next_task = await self.task_generator.generate_task(
-            candidate_level=session["current_level"],
-            focus_skills=session["strategy"]["focus_areas"],
-            task_number=session["current_task_index"] + 1,
-            previous_performance={
-                "score": evaluation["score"],
-                "time": time_spent,
-                "errors": test_results.get("failed_tests", 0)
-            },
-            resume_context=session["resume_analysis"]
-        )
+        # 4. Следующая задача (адаптивная): спекулятивная подходит, если уровень совпал
+        performance = {
+            "score": evaluation["score"],
+            "time": time_spent,
+            "errors": test_results.get("failed_tests", 0)
+        }
+        actual_level = self.task_generator.next_level(session["current_level"], performance)
+        if speculative_task and actual_level == speculative_level:
+            next_task = await speculative_task
+        else:
+            if speculative_task:
+                speculative_task.cancel()
+            print(f"[Session {session_id}] Regenerating next task for level {actual_level}...")
+            next_task = await self._generate_next_task(session, next_task_number, performance)
         
         session["tasks"].append(next_task)
         
@@ -195,10 +309,33 @@ class InterviewSession:
             "current_progress": {
                 "completed_tasks": session["current_task_index"],
                 "total_tasks": session["num_tasks"],
-                "average_score": sum(session["scores"]) / len(session["scores"])
+                "average_score": session["score_sum"] / session["score_count"]
             }
         }
     
+    async def _generate_next_task(
+        self,
+        session: Dict[str, Any],
+        task_number: int,
+        previous_performance: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Генерация следующей адаптивной задачи интервью"""
+        return await self.task_generator.generate_task(
+            candidate_level=session["current_level"],
+            focus_skills=session["strategy"]["focus_areas"],
+            task_number=task_number,
+            previous_performance=previous_performance,
+            resume_context=session["resume_analysis"]
+        )
+    
+    def _estimate_score(self, task: Dict[str, Any], test_results: Dict[str, Any]) -> float:
+        """Грубая оценка скора до проверки: доля пройденных тестов (0-100)"""
+        test_cases = task.get("test_cases", {})
+        total = len(test_cases.get("visible", [])) + len(test_cases.get("hidden", []))
+        passed = test_results.get("visible_passed", 0) + test_results.get("hidden_passed", 0)
+        # Без тестов считаем результат средним - уровень не меняется
+        return passed / total * 100 if total else 50
+    
     async def generate_final_report(self, session_id: str) -> Dict[str, Any]:
         """
         Генерация финального отчета по интервью
@@ -210,7 +347,7 @@ class InterviewSession:
         - Детали по каждой задаче
         - Рекомендации
         """
-        session = self.sessions.get(session_id)
+        session = self._get_session(session_id)
         if not session:
             raise ValueError(f"Session {session_id} not found")
         
@@ -219,57 +356,54 @@ class InterviewSession:
         resume_analysis = session["resume_analysis"]
         
         # 1. Общие метрики
-        average_score = sum(scores) / len(scores) if scores else 0
+        average_score = session["score_sum"] / session["score_count"] if session["score_count"] else 0
         passed_tasks = sum(1 for s in scores if s >= 60)
         
-        # 2. LLM анализ всего интервью
-        prompt = f"""Проанализируй интервью кандидата и дай рекомендацию.
-
-Позиция: {session['job_position']}
-Уровень кандидата: {resume_analysis['candidate_level']}
-Опыт: {resume_analysis['experience_years']} лет
-Навыки: {', '.join(resume_analysis['primary_skills'])}
-
-Результаты задач:
-"""
-        for i, sol in enumerate(solutions, 1):
-            prompt += f"\nЗадача {i}: {sol['evaluation']['score']}/100 - {sol['evaluation']['verdict']}\n"
+        # 2. Однозначный исход (все решено отлично / провал) - без LLM
+        llm_verdict = self._obvious_verdict(resume_analysis, scores, average_score, passed_tasks)
         
-        prompt += f"""
-Средний балл: {average_score:.0f}/100
-Успешно решено: {passed_tasks}/{len(scores)}
-
-Дай финальный вердикт в JSON:
-{{
-  "decision": "hire" или "reject" или "maybe",
-  "confidence": 85,
-  "summary": "Краткое резюме на 2-3 предложения",
-  "strengths": ["Сильная сторона 1", "Сильная сторона 2"],
-  "weaknesses": ["Слабая сторона 1", "Слабая сторона 2"],
-  "recommendations": ["Рекомендация 1", "Рекомендация 2"],
-  "fit_for_level": "Middle"
-}}"""
-
-        try:
-            content = await self.client.async_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
-                model="qwen3-coder",
-                temperature=0.5
+        # LLM анализ всего интервью
+        if llm_verdict is None:
+            parts: List[str] = [_FINAL_REPORT_HEADER.format(
+                job_position=session['job_position'],
+                level=resume_analysis['candidate_level'],
+                experience=resume_analysis['experience_years'],
+                skills=', '.join(resume_analysis['primary_skills'])
+            )]
+            parts.extend(
+                f"\nЗадача {i}: {sol['evaluation']['score']}/100 - {sol['evaluation']['verdict']}\n"
+                for i, sol in enumerate(solutions, 1)
             )
-            
-            llm_verdict = self._extract_json_from_text(content)
-            
-        except Exception as e:
-            print(f"Error generating final report: {e}")
-            llm_verdict = {
-                "decision": "maybe",
-                "confidence": 50,
-                "summary": "Требуется дополнительная оценка",
-                "strengths": [],
-                "weaknesses": [],
-                "recommendations": [],
-                "fit_for_level": resume_analysis["candidate_level"]
-            }
+            parts.append(_FINAL_REPORT_FOOTER.format(
+                average_score=average_score,
+                passed=passed_tasks,
+                total=len(scores)
+            ))
+            user_content = "".join(parts)
+
+            try:
+                content = await self.client.async_chat_completion(
+                    messages=[
+                        {"role": "system", "content": _FINAL_REPORT_SYSTEM},
+                        {"role": "user", "content": user_content}
+                    ],
+                    model="qwen3-coder",
+                    temperature=0.5
+                )
+                
+                llm_verdict = extract_json_from_text(content)
+                
+            except Exception as e:
+                print(f"Error generating final report: {e}")
+                llm_verdict = {
+                    "decision": "maybe",
+                    "confidence": 50,
+                    "summary": "Требуется дополнительная оценка",
+                    "strengths": [],
+                    "weaknesses": [],
+                    "recommendations": [],
+                    "fit_for_level": resume_analysis["candidate_level"]
+                }
         
         # 3. Формирование отчета
         return {
@@ -284,7 +418,7 @@ class InterviewSession:
                 "completed_tasks": len(scores),
                 "average_score": average_score,
                 "passed_tasks": passed_tasks,
-                "total_time": sum(s["time_spent"] for s in solutions)
+                "total_time": session["total_time"]
             },
             "task_details": [
                 {
@@ -309,41 +443,118 @@ class InterviewSession:
             "duration": self._calculate_duration(session)
         }
     
-    def _calculate_duration(self, session: Dict[str, Any]) -> int:
-        """Расчет общей длительности интервью в секундах"""
-        started = datetime.fromisoformat(session["started_at"])
-        completed = datetime.fromisoformat(session.get("completed_at", datetime.utcnow().isoformat()))
-        return int((completed - started).total_seconds())
+    def _get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Сессия из памяти или, если она была выгружена, из sqlite"""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            return session
+        
+        db = self._open_spill_db(create=False)
+        if db is None:
+            return None
+        
+        row = db.execute(
+            "SELECT data FROM interview_sessions WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
     
-    def _extract_json_from_text(self, text: str) -> Any:
-        """Извлечение JSON из текста LLM"""
-        import json
-        import re
+    def _store_session(self, session_id: str, session: Dict[str, Any]):
+        """Сохранить сессию в память с соблюдением лимита"""
+        self.sessions[session_id] = session
+        self._evict_sessions()
+    
+    def _evict_sessions(self):
+        """
+        Выгрузка самых давних завершенных сессий в sqlite сверх MAX_LIVE_SESSIONS
         
-        try:
-            return json.loads(text)
-        except:
-            pass
+        Активные сессии не выгружаются никогда.
+        """
+        excess = len(self.sessions) - self.MAX_LIVE_SESSIONS
+        if excess <= 0:
+            return
         
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\}|\[.*?\])\s*```', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
+        evicted = []
+        for session_id, session in self.sessions.items():
+            if session["status"] == "completed":
+                evicted.append(session_id)
+                if len(evicted) == excess:
+                    break
         
-        json_match = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
+        if not evicted:
+            return
         
-        return {}
+        db = self._open_spill_db(create=True)
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO interview_sessions (session_id, data) VALUES (?, ?)",
+                [
+                    (session_id, pickle.dumps(self.sessions.pop(session_id), pickle.HIGHEST_PROTOCOL))
+                    for session_id in evicted
+                ]
+            )
+    
+    def _open_spill_db(self, create: bool) -> Optional[sqlite3.Connection]:
+        """Ленивое подключение к sqlite (файл создается только при первой выгрузке)"""
+        if self._spill_db is None:
+            if not create and not os.path.exists(self._spill_path):
+                return None
+            self._spill_db = sqlite3.connect(self._spill_path, check_same_thread=False)
+            self._spill_db.execute(
+                "CREATE TABLE IF NOT EXISTS interview_sessions (session_id TEXT PRIMARY KEY, data BLOB NOT NULL)"
+            )
+        return self._spill_db
+    
+    def _obvious_verdict(
+        self,
+        resume_analysis: Dict[str, Any],
+        scores: List[int],
+        average_score: float,
+        passed_tasks: int
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Шаблонный вердикт для однозначных результатов
+        
+        hire: средний балл >= 85 и все задачи решены; reject: средний балл <= 30.
+        Для остальных случаев None - решение принимает LLM.
+        """
+        if not scores:
+            return None
+        
+        if average_score >= 85 and passed_tasks == len(scores):
+            return {
+                "decision": "hire",
+                "confidence": 95,
+                "summary": "Все задачи решены на высоком уровне.",
+                "strengths": resume_analysis.get("strengths", []),
+                "weaknesses": resume_analysis.get("gaps", []),
+                "recommendations": [],
+                "fit_for_level": resume_analysis["candidate_level"]
+            }
+        
+        if average_score <= 30:
+            return {
+                "decision": "reject",
+                "confidence": 90,
+                "summary": "Большинство задач не решено, уровень кандидата ниже требуемого.",
+                "strengths": resume_analysis.get("strengths", []),
+                "weaknesses": resume_analysis.get("gaps", []),
+                "recommendations": [],
+                "fit_for_level": resume_analysis["candidate_level"]
+            }
+        
+        return None
+    
+    def _calculate_duration(self, session: Dict[str, Any]) -> int:
+        """Расчет общей длительности интервью в секундах"""
+        # Числовые метки вместо разбора ISO строк; time.time(), а не monotonic,
+        # потому что сессия может пережить процесс через sqlite
+        return int(session.get("completed_at_ts", time.time()) - session["started_at_ts"])
     
     def get_session_status(self, session_id: str) -> Dict[str, Any]:
         """Получить текущий статус сессии"""
-        session = self.sessions.get(session_id)
+        session = self._get_session(session_id)
         if not session:
             return {"error": "Session not found"}
         
@@ -353,7 +564,7 @@ class InterviewSession:
             "current_task": session["current_task_index"] + 1,
             "total_tasks": session["num_tasks"],
             "scores": session["scores"],
-            "average_score": sum(session["scores"]) / len(session["scores"]) if session["scores"] else 0
+            "average_score": session["score_sum"] / session["score_count"] if session["score_count"] else 0
         }
 
 
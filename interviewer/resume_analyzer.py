@@ -2,14 +2,182 @@
 Resume Analyzer - Анализ резюме кандидата через LLM
 Извлекает навыки, опыт, уровень и генерирует персонализированные вопросы
 """
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from collections import OrderedDict
 from datetime import datetime
-import json
-import re
+from types import MappingProxyType
+import copy
+import hashlib
+import asyncio
 
+from ._json_utils import extract_json_from_text, parse_json_prefix, dumps_json
+from ._text_utils import truncate_to_tokens
 from config.scibox import SciBoxClient
 
 
+# Статичные инструкции вынесены в system сообщение: префикс промпта одинаков
+# для всех кандидатов, и провайдер может переиспользовать его из кэша
+_PARSE_RESUME_SYSTEM = """Проанализируй резюме из сообщения пользователя и извлеки структурированную информацию.
+
+Верни JSON в формате:
+{
+  "name": "Имя Фамилия",
+  "experience_years": 3,
+  "positions": [
+    {
+      "title": "Backend Developer",
+      "company": "Tech Corp",
+      "duration": "2 года",
+      "technologies": ["Python", "Django", "PostgreSQL"]
+    }
+  ],
+  "skills": {
+    "languages": ["Python", "JavaScript"],
+    "frameworks": ["FastAPI", "React"],
+    "databases": ["PostgreSQL", "MongoDB"],
+    "tools": ["Docker", "Git", "CI/CD"]
+  },
+  "projects": [
+    {
+      "name": "E-commerce API",
+      "description": "REST API с 50k+ пользователей",
+      "technologies": ["Python", "FastAPI", "Redis"]
+    }
+  ],
+  "education": {
+    "degree": "Бакалавр",
+    "field": "Компьютерные науки",
+    "university": "МГУ"
+  }
+}
+
+Будь точным. Если информация отсутствует, укажи null."""
+
+_ANALYZE_SKILLS_SYSTEM = """Проанализируй навыки кандидата для позиции, указанной в сообщении пользователя.
+
+Верни JSON:
+{
+  "primary": ["Топ-3 сильных навыка"],
+  "secondary": ["Дополнительные навыки"],
+  "strengths": ["Что выделяет кандидата"],
+  "gaps": ["Чего не хватает для позиции"]
+}"""
+
+_GEN_QUESTIONS_SYSTEM = """Сгенерируй 5 персонализированных вопросов для технического интервью по данным кандидата из сообщения пользователя.
+
+Правила:
+1. Вопросы должны быть КОНКРЕТНЫМИ про опыт кандидата
+2. Проверяй реальные знания, а не теорию
+3. Каждый вопрос привязан к проекту/технологии из резюме
+
+Формат ответа (JSON):
+[
+  {
+    "question": "В проекте X вы использовали FastAPI. Как вы решали проблему N+1 queries?",
+    "type": "technical",
+    "focus": "FastAPI",
+    "difficulty": "middle"
+  },
+  ...
+]
+
+Верни только JSON массив, без дополнительного текста."""
+
+_COMBINED_RESUME_SYSTEM = """Проанализируй резюме кандидата из сообщения пользователя для указанной там позиции.
+
+Верни ОДИН JSON объект с тремя разделами строго в этом порядке:
+{
+  "parsed": {
+    "name": "Имя Фамилия",
+    "experience_years": 3,
+    "positions": [{"title": "Backend Developer", "company": "Tech Corp", "duration": "2 года", "technologies": ["Python"]}],
+    "skills": {"languages": ["Python"], "frameworks": ["FastAPI"], "databases": ["PostgreSQL"], "tools": ["Docker"]},
+    "projects": [{"name": "E-commerce API", "description": "REST API с 50k+ пользователей", "technologies": ["Python", "FastAPI"]}],
+    "education": {"degree": "Бакалавр", "field": "Компьютерные науки", "university": "МГУ"}
+  },
+  "skills_analysis": {
+    "primary": ["Топ-3 сильных навыка"],
+    "secondary": ["Дополнительные навыки"],
+    "strengths": ["Что выделяет кандидата"],
+    "gaps": ["Чего не хватает для позиции"]
+  },
+  "questions": [
+    {"question": "В проекте X вы использовали FastAPI. Как вы решали проблему N+1 queries?", "type": "technical", "focus": "FastAPI", "difficulty": "middle"}
+  ]
+}
+
+Правила:
+1. В "parsed" будь точным. Если информация отсутствует, укажи null
+2. В "questions" ровно 5 вопросов, КОНКРЕТНЫХ про опыт кандидата, каждый привязан к проекту/технологии из резюме
+3. Сложность вопросов: junior при опыте до 2 лет, middle - от 2 до 5 лет, senior - от 5 лет
+
+Верни только JSON, без дополнительного текста."""
+
+# Базовые вопросы если LLM не сработал (по уровню кандидата)
+_FALLBACK_QUESTIONS = MappingProxyType({
+    "Junior": (
+        MappingProxyType({
+            "question": "Расскажите о вашем самом сложном проекте из резюме",
+            "type": "behavioral",
+            "focus": "projects",
+            "difficulty": "junior"
+        }),
+        MappingProxyType({
+            "question": "Какие технологии из вашего стека вы знаете лучше всего?",
+            "type": "technical",
+            "focus": "skills",
+            "difficulty": "junior"
+        })
+    ),
+    "Middle": (
+        MappingProxyType({
+            "question": "Опишите архитектуру одного из ваших проектов",
+            "type": "technical",
+            "focus": "architecture",
+            "difficulty": "middle"
+        }),
+        MappingProxyType({
+            "question": "Как вы решали проблемы с производительностью?",
+            "type": "problem-solving",
+            "focus": "optimization",
+            "difficulty": "middle"
+        })
+    ),
+    "Senior": (
+        MappingProxyType({
+            "question": "Как вы принимали технические решения в ваших проектах?",
+            "type": "leadership",
+            "focus": "decision-making",
+            "difficulty": "senior"
+        }),
+        MappingProxyType({
+            "question": "Опишите систему, которую вы проектировали с нуля",
+            "type": "system-design",
+            "focus": "architecture",
+            "difficulty": "senior"
+        })
+    )
+})
+
+
+def _strategy_template(level: str) -> Dict[str, Any]:
+    """Статичная часть стратегии интервью для уровня"""
+    return {
+        "time_allocation": {
+            "coding": 40,
+            "theory": 30,
+            "projects": 30
+        },
+        "adaptive_strategy": f"Начать с {level} задач, адаптировать по результатам"
+    }
+
+
+# Шаблоны стратегий строятся один раз на модуль
+_STRATEGY_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    level: _strategy_template(level) for level in ("Junior", "Middle", "Senior")
+}
+
+
 class ResumeAnalyzer:
     """
     Анализатор резюме для персонализации интервью
@@ -21,13 +189,22 @@ class ResumeAnalyzer:
     - Генерации персонализированных вопросов
     """
     
+    # Бюджеты промптов в токенах (не в символах: кириллица занимает больше токенов)
+    RESUME_MAX_TOKENS = 2000
+    CONTEXT_MAX_TOKENS = 250
+    
+    # LRU кэш готовых анализов (повторные запуски с тем же резюме)
+    ANALYSIS_CACHE_SIZE = 256
+    
     def __init__(self, scibox_client: SciBoxClient):
         self.client = scibox_client
+        self._analysis_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
     
     async def analyze_resume(
         self,
         resume_text: str,
-        job_position: Optional[str] = None
+        job_position: Optional[str] = None,
+        on_profile: Optional[Callable[[Dict[str, Any]], None]] = None
     ) -> Dict[str, Any]:
         """
         Полный анализ резюме
@@ -35,6 +212,10 @@ class ResumeAnalyzer:
         Args:
             resume_text: Текст резюме (PDF/DOCX конвертирован в текст)
             job_position: Целевая позиция (для фокусировки вопросов)
+            on_profile: Вызывается посреди генерации, как только известны уровень
+                и топ-3 навыка - {"parsed_data", "candidate_level", "focus_skills"};
+                вопросы в этот момент еще генерируются. Не вызывается, если
+                ответ берется из кэша или общий вызов не удался
         
         Returns:
             {
@@ -51,23 +232,54 @@ class ResumeAnalyzer:
                 "personalized_questions": [...]
             }
         """
-        # 1. Парсинг резюме через LLM
-        parsed_data = await self._parse_resume_structure(resume_text)
+        cache_key = hashlib.sha256(
+            f"{job_position}\0{resume_text}".encode("utf-8")
+        ).hexdigest()
+        cached = self._analysis_cache.get(cache_key)
+        if cached is not None:
+            self._analysis_cache.move_to_end(cache_key)
+            # Вызывающий код может менять результат - отдаем копию
+            return copy.deepcopy(cached)
+        
+        # 1. Парсинг, анализ навыков и вопросы одним LLM вызовом (текст резюме
+        # уходит в LLM один раз); если ответ не разобрался - раздельные вызовы
+        combined = await self._analyze_resume_combined(resume_text, job_position, on_profile)
+        if combined is not None:
+            parsed_data = combined["parsed"]
+        else:
+            parsed_data = await self._parse_resume_structure(resume_text)
         
         # 2. Определение уровня
         candidate_level = await self._determine_level(parsed_data)
         
-        # 3. Анализ навыков
-        skills_analysis = await self._analyze_skills(parsed_data, job_position)
-        
-        # 4. Генерация персонализированных вопросов
-        questions = await self._generate_personalized_questions(
-            parsed_data,
-            candidate_level,
-            job_position
-        )
+        if combined is not None:
+            skills_analysis = combined["skills"]
+            questions = combined["questions"]
+            used_fallback = combined["skills_fallback"] or not questions
+            if not questions:
+                questions = self._get_fallback_questions(candidate_level)
+        else:
+            # 3-4. Анализ навыков и генерация вопросов не зависят друг от друга - параллельно
+            skills_result, questions_result = await asyncio.gather(
+                self._analyze_skills(parsed_data, job_position),
+                self._generate_personalized_questions(
+                    parsed_data,
+                    candidate_level,
+                    job_position
+                ),
+                return_exceptions=True
+            )
+            if isinstance(skills_result, BaseException):
+                print(f"Error analyzing skills: {skills_result}")
+                skills_result = (self._get_fallback_skills(parsed_data), True)
+            if isinstance(questions_result, BaseException):
+                print(f"Error generating questions: {questions_result}")
+                questions_result = (self._get_fallback_questions(candidate_level), True)
+            skills_analysis, skills_fallback = skills_result
+            questions, questions_fallback = questions_result
+            used_fallback = skills_fallback or questions_fallback
         
-        return {
+        analysis = {
             "candidate_level": candidate_level,
             "experience_years": parsed_data.get("experience_years", 0),
             "primary_skills": skills_analysis["primary"],
@@ -81,6 +293,109 @@ class ResumeAnalyzer:
             "personalized_questions": questions,
             "analysis_timestamp": datetime.utcnow().isoformat()
         }
+        
+        # Неудачный парсинг и заглушки вместо ответа LLM не кэшируем,
+        # чтобы повтор мог пройти успешно
+        if parsed_data and not used_fallback:
+            self._analysis_cache[cache_key] = copy.deepcopy(analysis)
+            if len(self._analysis_cache) > self.ANALYSIS_CACHE_SIZE:
+                self._analysis_cache.popitem(last=False)
+        
+        return analysis
+    
+    async def _analyze_resume_combined(
+        self,
+        resume_text: str,
+        job_position: Optional[str],
+        on_profile: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Парсинг, анализ навыков и вопросы одним LLM вызовом
+        
+        Ответ стримится: когда разделы parsed и skills_analysis закрылись,
+        профиль кандидата отдается в on_profile, не дожидаясь вопросов.
+        
+        Returns:
+            {"parsed": {...}, "skills": {...}, "skills_fallback": bool, "questions": [...]}
+            или None, если ответ не удалось разобрать (тогда используются раздельные вызовы)
+        """
+        user_content = f"""Позиция: {job_position or 'Backend Developer'}
+
+Резюме:
+{truncate_to_tokens(resume_text, self.RESUME_MAX_TOKENS)}"""
+
+        parts: List[str] = []
+        profile_sent = on_profile is None
+        try:
+            async for delta in self.client.async_chat_completion_stream(
+                messages=[
+                    {"role": "system", "content": _COMBINED_RESUME_SYSTEM},
+                    {"role": "user", "content": user_content}
+                ],
+                model="qwen3-coder",
+                temperature=0.4,
+                max_tokens=3000
+            ):
+                parts.append(delta)
+                if not profile_sent and "}" in delta:
+                    sections = self._combined_sections(
+                        parse_json_prefix("".join(parts), "skills_analysis")
+                    )
+                    if sections is not None:
+                        profile_sent = True
+                        parsed, skills, _ = sections
+                        on_profile({
+                            "parsed_data": parsed,
+                            "candidate_level": await self._determine_level(parsed),
+                            "focus_skills": skills["primary"][:3]
+                        })
+        except Exception as e:
+            print(f"Error in combined resume analysis: {e}")
+            return None
+        
+        result = extract_json_from_text("".join(parts))
+        sections = self._combined_sections(result)
+        if sections is None:
+            return None
+        
+        parsed, skills, skills_fallback = sections
+        questions = result.get("questions")
+        if not isinstance(questions, list):
+            questions = []
+        
+        return {
+            "parsed": parsed,
+            "skills": skills,
+            "skills_fallback": skills_fallback,
+            "questions": questions[:5]
+        }
+    
+    def _combined_sections(
+        self,
+        result: Any
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any], bool]]:
+        """
+        Разделы parsed и skills_analysis из ответа общего вызова (или его начала)
+        
+        Невалидный анализ навыков заменяется навыками из резюме как есть.
+        
+        Returns:
+            (parsed, skills, skills_fallback) или None, если parsed не разобрался;
+            skills_fallback - True, если навыки взяты из резюме вместо ответа LLM
+        """
+        if not isinstance(result, dict):
+            return None
+        
+        parsed = result.get("parsed")
+        skills = result.get("skills_analysis")
+        if not isinstance(parsed, dict) or not parsed:
+            return None
+        if not isinstance(skills, dict) or not all(
+            key in skills for key in ("primary", "secondary", "strengths", "gaps")
+        ):
+            return parsed, self._get_fallback_skills(parsed), True
+        
+        return parsed, skills, False
     
     async def _parse_resume_structure(self, resume_text: str) -> Dict[str, Any]:
         """
@@ -93,54 +408,21 @@ class ResumeAnalyzer:
         - Проекты
         - Образование
         """
-        prompt = f"""Проанализируй резюме и извлеки структурированную информацию.
-
-Резюме:
-{resume_text[:4000]}  # Ограничение на токены
-
-Верни JSON в формате:
-{{
-  "name": "Имя Фамилия",
-  "experience_years": 3,
-  "positions": [
-    {{
-      "title": "Backend Developer",
-      "company": "Tech Corp",
-      "duration": "2 года",
-      "technologies": ["Python", "Django", "PostgreSQL"]
-    }}
-  ],
-  "skills": {{
-    "languages": ["Python", "JavaScript"],
-    "frameworks": ["FastAPI", "React"],
-    "databases": ["PostgreSQL", "MongoDB"],
-    "tools": ["Docker", "Git", "CI/CD"]
-  }},
-  "projects": [
-    {{
-      "name": "E-commerce API",
-      "description": "REST API с 50k+ пользователей",
-      "technologies": ["Python", "FastAPI", "Redis"]
-    }}
-  ],
-  "education": {{
-    "degree": "Бакалавр",
-    "field": "Компьютерные науки",
-    "university": "МГУ"
-  }}
-}}
-
-Будь точным. Если информация отсутствует, укажи null."""
+        # Ограничение на токены
+        user_content = f"Резюме:\n{truncate_to_tokens(resume_text, self.RESUME_MAX_TOKENS)}"
 
         try:
             content = await self.client.async_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
+                messages=[
+                    {"role": "system", "content": _PARSE_RESUME_SYSTEM},
+                    {"role": "user", "content": user_content}
+                ],
                 model="qwen3-coder",  # Хорошо парсит структурированные данные
                 temperature=0.3  # Низкая для точности
             )
             
             # Извлечение JSON из ответа
-            parsed = self._extract_json_from_text(content)
+            parsed = extract_json_from_text(content)
             
             return parsed
             
@@ -173,60 +455,55 @@ class ResumeAnalyzer:
         self,
         parsed_data: Dict[str, Any],
         job_position: Optional[str]
-    ) -> Dict[str, Any]:
+    ) -> Tuple[Dict[str, Any], bool]:
         """
         Анализ навыков: сильные стороны и пробелы
         
         Сравнивает навыки кандидата с требованиями позиции
+        
+        Returns:
+            (analysis, fell_back) - fell_back True, если LLM не ответил
+            и вернулись навыки из резюме как есть
         """
         skills = parsed_data.get("skills", {})
-        all_skills = []
         
-        for category, skill_list in skills.items():
-            all_skills.extend(skill_list)
+        # При 3 навыках и меньше (или неудачном парсинге) ранжировать нечего - без LLM
+        fallback = self._get_fallback_skills(parsed_data)
+        if not fallback["secondary"]:
+            return fallback, False
         
         # LLM анализ: что хорошо, чего не хватает
-        prompt = f"""Проанализируй навыки кандидата для позиции {job_position or 'Backend Developer'}.
+        user_content = f"""Позиция: {job_position or 'Backend Developer'}
 
 Навыки кандидата:
-{json.dumps(skills, ensure_ascii=False, indent=2)}
+{dumps_json(skills)}
 
-Опыт: {parsed_data.get('experience_years', 0)} лет
-
-Верни JSON:
-{{
-  "primary": ["Топ-3 сильных навыка"],
-  "secondary": ["Дополнительные навыки"],
-  "strengths": ["Что выделяет кандидата"],
-  "gaps": ["Чего не хватает для позиции"]
-}}"""
+Опыт: {parsed_data.get('experience_years', 0)} лет"""
 
         try:
             content = await self.client.async_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
+                messages=[
+                    {"role": "system", "content": _ANALYZE_SKILLS_SYSTEM},
+                    {"role": "user", "content": user_content}
+                ],
                 model="qwen3-coder",
                 temperature=0.4
             )
             
-            analysis = self._extract_json_from_text(content)
+            analysis = extract_json_from_text(content)
             
-            return analysis
+            return analysis, False
             
         except Exception as e:
             print(f"Error analyzing skills: {e}")
-            return {
-                "primary": all_skills[:3],
-                "secondary": all_skills[3:],
-                "strengths": [],
-                "gaps": []
-            }
+            return fallback, True
     
     async def _generate_personalized_questions(
         self,
         parsed_data: Dict[str, Any],
         candidate_level: str,
         job_position: Optional[str]
-    ) -> List[Dict[str, Any]]:
+    ) -> Tuple[List[Dict[str, Any]], bool]:
         """
         Генерация персонализированных вопросов на основе резюме
         
@@ -234,140 +511,70 @@ class ResumeAnalyzer:
         1. О проектах из резюме (детали реализации)
         2. О технологиях (проверка глубины знаний)
         3. Ситуационные (на основе опыта)
+        
+        Returns:
+            (questions, fell_back) - fell_back True, если вместо ответа LLM
+            вернулись базовые вопросы
         """
         projects = parsed_data.get("projects", [])
         skills = parsed_data.get("skills", {})
         positions = parsed_data.get("positions", [])
         
-        prompt = f"""Сгенерируй 5 персонализированных вопросов для технического интервью.
-
-Кандидат: {candidate_level} уровень
+        user_content = f"""Кандидат: {candidate_level} уровень
 Позиция: {job_position or 'Backend Developer'}
 
 Проекты:
-{json.dumps(projects, ensure_ascii=False, indent=2)[:1000]}
+{truncate_to_tokens(dumps_json(projects), self.CONTEXT_MAX_TOKENS)}
 
 Навыки:
-{json.dumps(skills, ensure_ascii=False, indent=2)}
+{dumps_json(skills)}
 
 Опыт:
-{json.dumps(positions, ensure_ascii=False, indent=2)[:1000]}
-
-Правила:
-1. Вопросы должны быть КОНКРЕТНЫМИ про опыт кандидата
-2. Проверяй реальные знания, а не теорию
-3. Каждый вопрос привязан к проекту/технологии из резюме
-
-Формат ответа (JSON):
-[
-  {{
-    "question": "В проекте X вы использовали FastAPI. Как вы решали проблему N+1 queries?",
-    "type": "technical",
-    "focus": "FastAPI",
-    "difficulty": "middle"
-  }},
-  ...
-]
-
-Верни только JSON массив, без дополнительного текста."""
+{truncate_to_tokens(dumps_json(positions), self.CONTEXT_MAX_TOKENS)}"""
 
         try:
             content = await self.client.async_chat_completion(
-                messages=[{"role": "user", "content": prompt}],
+                messages=[
+                    {"role": "system", "content": _GEN_QUESTIONS_SYSTEM},
+                    {"role": "user", "content": user_content}
+                ],
                 model="qwen3-coder",
                 temperature=0.7  # Креативность для разнообразия вопросов
             )
             
-            questions = self._extract_json_from_text(content)
+            questions = extract_json_from_text(content)
             
             # Проверка формата
             if isinstance(questions, list) and len(questions) > 0:
-                return questions[:5]
+                return questions[:5], False
             else:
-                return self._get_fallback_questions(candidate_level)
+                return self._get_fallback_questions(candidate_level), True
             
         except Exception as e:
             print(f"Error generating questions: {e}")
-            return self._get_fallback_questions(candidate_level)
+            return self._get_fallback_questions(candidate_level), True
     
-    def _extract_json_from_text(self, text: str) -> Any:
-        """
-        Извлечение JSON из текста LLM (может быть обернут в markdown)
-        """
-        # Попытка 1: прямой парсинг
-        try:
-            return json.loads(text)
-        except:
-            pass
-        
-        # Попытка 2: извлечение из markdown блока
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\}|\[.*?\])\s*```', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        # Попытка 3: поиск первого JSON объекта/массива
-        json_match = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        return {}
+    def _get_fallback_skills(self, parsed_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Навыки из распарсенного резюме если LLM не сработал"""
+        all_skills = []
+        
+        for category, skill_list in parsed_data.get("skills", {}).items():
+            all_skills.extend(skill_list)
+        
+        return {
+            "primary": all_skills[:3],
+            "secondary": all_skills[3:],
+            "strengths": [],
+            "gaps": []
+        }
     
     def _get_fallback_questions(self, level: str) -> List[Dict[str, Any]]:
         """Базовые вопросы если LLM не сработал"""
-        base_questions = {
-            "Junior": [
-                {
-                    "question": "Расскажите о вашем самом сложном проекте из резюме",
-                    "type": "behavioral",
-                    "focus": "projects",
-                    "difficulty": "junior"
-                },
-                {
-                    "question": "Какие технологии из вашего стека вы знаете лучше всего?",
-                    "type": "technical",
-                    "focus": "skills",
-                    "difficulty": "junior"
-                }
-            ],
-            "Middle": [
-                {
-                    "question": "Опишите архитектуру одного из ваших проектов",
-                    "type": "technical",
-                    "focus": "architecture",
-                    "difficulty": "middle"
-                },
-                {
-                    "question": "Как вы решали проблемы с производительностью?",
-                    "type": "problem-solving",
-                    "focus": "optimization",
-                    "difficulty": "middle"
-                }
-            ],
-            "Senior": [
-                {
-                    "question": "Как вы принимали технические решения в ваших проектах?",
-                    "type": "leadership",
-                    "focus": "decision-making",
-                    "difficulty": "senior"
-                },
-                {
-                    "question": "Опишите систему, которую вы проектировали с нуля",
-                    "type": "system-design",
-                    "focus": "architecture",
-                    "difficulty": "senior"
-                }
-            ]
-        }
-        
-        return base_questions.get(level, base_questions["Middle"])
+        # Отдаем свежие dict: общая константа не должна меняться вызывающим кодом
+        questions = _FALLBACK_QUESTIONS.get(level, _FALLBACK_QUESTIONS["Middle"])
+        return [dict(question) for question in questions]
     
-    async def get_interview_strategy(
+    def get_interview_strategy(
         self,
         resume_analysis: Dict[str, Any],
         interview_type: str = "technical"
@@ -389,16 +596,14 @@ class ResumeAnalyzer:
         """
         level = resume_analysis["candidate_level"]
         primary_skills = resume_analysis["primary_skills"]
+        template = _STRATEGY_TEMPLATES.get(level) or _strategy_template(level)
         
         return {
             "start_level": level,
             "focus_areas": primary_skills[:3],
-            "time_allocation": {
-                "coding": 40,
-                "theory": 30,
-                "projects": 30
-            },
-            "adaptive_strategy": f"Начать с {level} задач, адаптировать по результатам",
+            # Копия: вложенный dict шаблона общий для всех сессий
+            "time_allocation": dict(template["time_allocation"]),
+            "adaptive_strategy": template["adaptive_strategy"],
             "red_flags": resume_analysis.get("gaps", []),
             "strengths_to_validate": resume_analysis.get("strengths", [])
         }
@@ -1,14 +1,64 @@
 """
 Solution Checker - Проверка и оценка решений кандидата
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from collections import OrderedDict
 from datetime import datetime
-import json
-import re
+import asyncio
+import copy
+import hashlib
+import logging
 
+import numpy as np
+
+from ._json_utils import extract_json_from_text
+from ._text_utils import truncate_to_tokens
 from config.scibox import SciBoxClient
 
 
+logger = logging.getLogger(__name__)
+
+# Масштаб квантования нормированных эмбеддингов в int8
+_INT8_SCALE = 127
+_INT8_SCALE_SQUARED = _INT8_SCALE * _INT8_SCALE
+
+# Результаты по умолчанию, если отдельная проверка не удалась
+_FALLBACK_CORRECTNESS = {
+    "pass_rate": 0,
+    "visible_tests": {"passed": 0, "total": 0},
+    "hidden_tests": {"passed": 0, "total": 0},
+    "all_passed": False,
+    "score": 0
+}
+
+_FALLBACK_QUALITY = {
+    "readability": 70,
+    "style": 70,
+    "architecture": 70,
+    "documentation": 50,
+    "overall_score": 65,
+    "issues": [],
+    "good_practices": []
+}
+
+_FALLBACK_EFFICIENCY = {
+    "time_complexity": "Unknown",
+    "space_complexity": "Unknown",
+    "meets_requirements": True,
+    "efficiency_score": 70,
+    "optimizations": [],
+    "bottlenecks": []
+}
+
+_FALLBACK_ORIGINALITY = {
+    "originality_score": 100,
+    "is_original": True,
+    "max_similarity": 0.0,
+    "similar_source": None,
+    "verdict": "Проверка недоступна"
+}
+
+
 class SolutionChecker:
     """
     Проверяльщик решений с использованием LLM + эмбеддингов
@@ -21,9 +71,28 @@ class SolutionChecker:
     - Генерация обратной связи
     """
     
+    # Бюджет кода решения в LLM промптах (в токенах)
+    SOLUTION_MAX_TOKENS = 500
+    
+    # С какого размера базы задачи сравнение уходит в пул потоков
+    SCAN_IN_EXECUTOR_MIN_ROWS = 256
+    
+    # Сколько известных решений хранить на задачу
+    MAX_KNOWN_PER_TASK = 2048
+    
+    # Сколько эмбеддингов решений держать в кеше (повторные проверки того же кода)
+    EMBEDDING_CACHE_SIZE = 512
+    
     def __init__(self, scibox_client: SciBoxClient):
         self.client = scibox_client
-        self.known_solutions_db = []  # База известных решений для проверки оригинальности
+        # База известных решений для проверки оригинальности: по каждой задаче
+        # эмбеддинги лежат строками одной матрицы (сравнение - одно умножение).
+        # Векторы нормированы и квантованы в int8 - в 4 раза меньше памяти
+        # Сверх MAX_KNOWN_PER_TASK старейшие решения перезаписываются (кольцевой буфер)
+        # {task_id: {"matrix": (capacity, D) int8, "sources": [...], "count": N, "next": i}}
+        self._emb_by_task: Dict[str, Dict[str, Any]] = {}
+        # LRU кеш квантованных эмбеддингов по blake2b(код решения)
+        self._emb_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
     
     async def check_solution(
         self,
@@ -53,46 +122,74 @@ class SolutionChecker:
                 "recommendations": [...]
             }
         """
-        # 1. Корректность (40%)
-        correctness = await self._check_correctness(
-            candidate_solution,
-            test_results,
-            task.get("test_cases", {})
-        )
+        # В LLM промпты код уходит один раз обрезанным по токенам
+        prompt_solution = truncate_to_tokens(candidate_solution, self.SOLUTION_MAX_TOKENS)
         
-        # 2. Качество кода (30%)
-        quality = await self._analyze_code_quality(
-            candidate_solution,
-            candidate_level
-        )
+        # 1. Корректность (40%) - без LLM, нужна для промпта общего анализа
+        try:
+            correctness = await self._check_correctness(
+                candidate_solution,
+                test_results,
+                task.get("test_cases", {})
+            )
+        except Exception:
+            logger.warning("Error checking correctness", exc_info=True)
+            correctness = copy.deepcopy(_FALLBACK_CORRECTNESS)
         
-        # 3. Эффективность (20%)
-        efficiency = await self._analyze_efficiency(
-            candidate_solution,
-            task.get("requirements", [])
+        # 2-4. Качество кода (30%), эффективность (20%) и обратная связь - одним
+        # LLM вызовом, параллельно с оригинальностью (10%) через эмбеддинги
+        combined, originality = await asyncio.gather(
+            self._combined_analysis(
+                task,
+                prompt_solution,
+                candidate_level,
+                correctness
+            ),
+            self._check_originality(
+                candidate_solution,
+                task.get("task_id")
+            ),
+            return_exceptions=True
         )
+        if isinstance(originality, BaseException):
+            logger.warning("Error checking originality", exc_info=originality)
+            originality = copy.deepcopy(_FALLBACK_ORIGINALITY)
+        if isinstance(combined, BaseException):
+            logger.warning("Error in combined solution analysis", exc_info=combined)
+            combined = None
         
-        # 4. Оригинальность (10%)
-        originality = await self._check_originality(
-            candidate_solution,
-            task.get("task_id")
-        )
+        if combined is not None:
+            quality, efficiency, feedback = combined
+        else:
+            # Запасной путь: раздельные вызовы
+            quality, efficiency = await asyncio.gather(
+                self._analyze_code_quality(
+                    prompt_solution,
+                    candidate_level
+                ),
+                self._analyze_efficiency(
+                    prompt_solution,
+                    task.get("requirements", [])
+                )
+            )
+            feedback = None
         
         # 5. Расчет финального скора
         final_score = self._calculate_score(
             correctness, quality, efficiency, originality
         )
         
-        # 6. Генерация обратной связи
-        feedback = await self._generate_feedback(
-            task,
-            candidate_solution,
-            correctness,
-            quality,
-            efficiency,
-            originality,
-            final_score
-        )
+        # 6. Генерация обратной связи (если не пришла из общего анализа)
+        if feedback is None:
+            feedback = await self._generate_feedback(
+                task,
+                prompt_solution,
+                correctness,
+                quality,
+                efficiency,
+                originality,
+                final_score
+            )
         
         return {
             "score": final_score,
@@ -108,6 +205,101 @@ class SolutionChecker:
             "checked_at": datetime.utcnow().isoformat()
         }
     
+    async def _combined_analysis(
+        self,
+        task: Dict[str, Any],
+        solution: str,
+        level: str,
+        correctness: Dict[str, Any]
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]]:
+        """
+        Качество, эффективность и обратная связь одним LLM вызовом
+        
+        Код решения попадает в промпт один раз вместо трех.
+        
+        Returns:
+            (quality, efficiency, feedback) в тех же форматах, что у раздельных
+            методов, или None если ответ не удалось разобрать
+        """
+        requirements = task.get("requirements", [])
+        req_str = "\n".join(requirements) if requirements else "Нет специфичных требований"
+        
+        prompt = f"""Проанализируй решение кандидата ({level} разработчик) и дай обратную связь.
+
+Задача: {task.get('title')}
+
+Требования:
+{req_str}
+
+Код:
+```python
+{solution}
+```
+
+Корректность: {correctness.get('pass_rate', 0):.0f}% тестов пройдено
+
+Оцени:
+1. Качество кода (0-100): читаемость, стиль, архитектура, документация
+2. Эффективность алгоритма: сложность по времени и памяти, соответствие требованиям
+3. Обратную связь: сильные стороны (2-3), области для улучшения (2-3), рекомендации (3-4)
+
+Верни JSON:
+{{
+  "quality": {{
+    "readability": 85,
+    "style": 90,
+    "architecture": 75,
+    "documentation": 60,
+    "overall_score": 77,
+    "issues": ["Слишком длинная функция", "Нет docstrings"],
+    "good_practices": ["Хорошие имена переменных", "Обработка ошибок"]
+  }},
+  "efficiency": {{
+    "time_complexity": "O(n log n)",
+    "space_complexity": "O(n)",
+    "meets_requirements": true,
+    "efficiency_score": 85,
+    "optimizations": ["Можно использовать set вместо list для O(1) поиска"],
+    "bottlenecks": ["Вложенные циклы в строке 15"]
+  }},
+  "feedback": {{
+    "text": "Общая обратная связь на 3-4 предложения",
+    "strengths": ["Хорошая обработка edge cases", "Чистый код"],
+    "weaknesses": ["Можно оптимизировать", "Нет docstrings"],
+    "recommendations": ["Используйте set для O(1) поиска", "Добавьте документацию к функциям"]
+  }}
+}}
+
+Будь конструктивным и дружелюбным. Верни ТОЛЬКО JSON."""
+
+        try:
+            content = await self.client.async_chat_completion(
+                messages=[{"role": "user", "content": prompt}],
+                model="qwen3-coder",
+                temperature=0.4,
+                max_tokens=1500
+            )
+        except Exception:
+            logger.warning("Error in combined solution analysis", exc_info=True)
+            return None
+        
+        result = extract_json_from_text(content)
+        if not isinstance(result, dict):
+            return None
+        
+        quality = result.get("quality")
+        efficiency = result.get("efficiency")
+        feedback = result.get("feedback")
+        if not (
+            isinstance(quality, dict) and "overall_score" in quality
+            and isinstance(efficiency, dict) and "efficiency_score" in efficiency
+            and isinstance(feedback, dict)
+            and all(key in feedback for key in ("text", "strengths", "weaknesses", "recommendations"))
+        ):
+            return None
+        
+        return quality, efficiency, feedback
+    
     async def _check_correctness(
         self,
         solution: str,
@@ -162,7 +354,7 @@ class SolutionChecker:
 
 Код:
 ```python
-{solution[:2000]}
+{solution}
 ```
 
 Оцени по критериям (0-100 баллов):
@@ -189,21 +381,13 @@ class SolutionChecker:
                 temperature=0.4
             )
             
-            analysis = self._extract_json_from_text(content)
+            analysis = extract_json_from_text(content)
             
             return analysis
             
-        except Exception as e:
-            print(f"Error analyzing code quality: {e}")
-            return {
-                "readability": 70,
-                "style": 70,
-                "architecture": 70,
-                "documentation": 50,
-                "overall_score": 65,
-                "issues": [],
-                "good_practices": []
-            }
+        except Exception:
+            logger.warning("Error analyzing code quality", exc_info=True)
+            return copy.deepcopy(_FALLBACK_QUALITY)
     
     async def _analyze_efficiency(
         self,
@@ -224,7 +408,7 @@ class SolutionChecker:
 
 Код:
 ```python
-{solution[:2000]}
+{solution}
 ```
 
 Требования:
@@ -249,20 +433,13 @@ class SolutionChecker:
                 temperature=0.3
             )
             
-            analysis = self._extract_json_from_text(content)
+            analysis = extract_json_from_text(content)
             
             return analysis
             
-        except Exception as e:
-            print(f"Error analyzing efficiency: {e}")
-            return {
-                "time_complexity": "Unknown",
-                "space_complexity": "Unknown",
-                "meets_requirements": True,
-                "efficiency_score": 70,
-                "optimizations": [],
-                "bottlenecks": []
-            }
+        except Exception:
+            logger.warning("Error analyzing efficiency", exc_info=True)
+            return copy.deepcopy(_FALLBACK_EFFICIENCY)
     
     async def _check_originality(
         self,
@@ -278,26 +455,22 @@ class SolutionChecker:
         - Решениями других кандидатов на эту же задачу
         """
         try:
-            # Генерация эмбеддинга для текущего решения
-            embedding = await self.client.async_generate_embedding(
-                text=solution,
-                model="bge-m3"
-            )
+            # Эмбеддинг текущего решения (из кеша, если код уже проверялся)
+            query = await self._get_solution_embedding(solution)
             
-            # Сравнение с базой известных решений
-            max_similarity = 0.0
-            most_similar_source = None
-            
-            for known_solution in self.known_solutions_db:
-                if known_solution.get("task_id") == task_id:
-                    similarity = self._cosine_similarity(
-                        embedding,
-                        known_solution["embedding"]
-                    )
-                    
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        most_similar_source = known_solution.get("source", "unknown")
+            # Сравнение с базой известных решений; большую матрицу считаем
+            # в пуле потоков, чтобы не блокировать event loop
+            known = self._emb_by_task.get(task_id)
+            if known and known["count"] >= self.SCAN_IN_EXECUTOR_MIN_ROWS:
+                loop = asyncio.get_running_loop()
+                max_similarity, most_similar_source = await loop.run_in_executor(
+                    None,
+                    self._scan_known_solutions,
+                    task_id,
+                    query
+                )
+            else:
+                max_similarity, most_similar_source = self._scan_known_solutions(task_id, query)
             
             # Оценка оригинальности (inverse similarity)
             originality_score = max(0, 100 - (max_similarity * 100))
@@ -305,12 +478,7 @@ class SolutionChecker:
             is_original = originality_score > 70  # Порог оригинальности
             
             # Сохранение решения в базу для будущих проверок
-            self.known_solutions_db.append({
-                "task_id": task_id,
-                "embedding": embedding,
-                "source": "candidate_solution",
-                "timestamp": datetime.utcnow().isoformat()
-            })
+            self._add_known_solution(task_id, query, "candidate_solution")
             
             return {
                 "originality_score": originality_score,
@@ -320,29 +488,98 @@ class SolutionChecker:
                 "verdict": "Уникальное решение" if is_original else "Возможно скопировано"
             }
             
-        except Exception as e:
-            print(f"Error checking originality: {e}")
-            return {
-                "originality_score": 100,
-                "is_original": True,
-                "max_similarity": 0.0,
-                "similar_source": None,
-                "verdict": "Проверка недоступна"
-            }
+        except Exception:
+            logger.warning("Error checking originality", exc_info=True)
+            return copy.deepcopy(_FALLBACK_ORIGINALITY)
     
-    def _cosine_similarity(self, emb1: List[float], emb2: List[float]) -> float:
-        """Вычисление косинусной близости между двумя эмбеддингами"""
-        if not emb1 or not emb2 or len(emb1) != len(emb2):
-            return 0.0
+    async def _get_solution_embedding(self, solution: str) -> np.ndarray:
+        """Квантованный эмбеддинг решения; повторная проверка того же кода обходится без запроса"""
+        cache_key = hashlib.blake2b(solution.encode("utf-8"), digest_size=16).digest()
         
-        dot_product = sum(a * b for a, b in zip(emb1, emb2))
-        magnitude1 = sum(a * a for a in emb1) ** 0.5
-        magnitude2 = sum(b * b for b in emb2) ** 0.5
+        query = self._emb_cache.get(cache_key)
+        if query is not None:
+            self._emb_cache.move_to_end(cache_key)
+            return query
         
-        if magnitude1 == 0 or magnitude2 == 0:
-            return 0.0
+        embedding = await self.client.async_generate_embedding(
+            text=solution,
+            model="bge-m3"
+        )
+        query = self._quantize_embedding(embedding)
+        
+        self._emb_cache[cache_key] = query
+        if len(self._emb_cache) > self.EMBEDDING_CACHE_SIZE:
+            self._emb_cache.popitem(last=False)
         
-        return dot_product / (magnitude1 * magnitude2)
+        return query
+    
+    def _scan_known_solutions(
+        self,
+        task_id: str,
+        query: np.ndarray
+    ) -> Tuple[float, Optional[str]]:
+        """Максимальная близость к известным решениям задачи за одно умножение матрицы"""
+        known = self._emb_by_task.get(task_id)
+        if not known or not known["count"] or known["matrix"].shape[1] != query.shape[0]:
+            return 0.0, None
+        
+        count = known["count"]
+        # Скалярное произведение int8 векторов считаем в float32 через BLAS:
+        # векторы нормированы, |dot| <= ~127^2, поэтому сумма точна (int16
+        # переполнится, а целочисленный matmul в numpy идет без BLAS)
+        dots = known["matrix"][:count].astype(np.float32) @ query.astype(np.float32)
+        best = int(dots.argmax())
+        similarity = float(dots[best]) / _INT8_SCALE_SQUARED
+        if similarity <= 0:
+            return 0.0, None
+        
+        return min(1.0, similarity), known["sources"][best]
+    
+    def _quantize_embedding(self, embedding: List[float]) -> np.ndarray:
+        """L2-нормировка и симметричное квантование в int8 (косинус = dot / 127^2)"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        if norm == 0:
+            return np.zeros(vector.shape, dtype=np.int8)
+        return np.round(vector / norm * _INT8_SCALE).astype(np.int8)
+    
+    def _add_known_solution(
+        self,
+        task_id: str,
+        embedding: np.ndarray,
+        source: str
+    ):
+        """
+        Добавить квантованный эмбеддинг в матрицу задачи
+        
+        Емкость растет удвоением до MAX_KNOWN_PER_TASK, дальше новые решения
+        замещают самые старые.
+        """
+        known = self._emb_by_task.get(task_id)
+        if known is None or known["matrix"].shape[1] != embedding.shape[0]:
+            known = {
+                "matrix": np.empty((min(16, self.MAX_KNOWN_PER_TASK), embedding.shape[0]), dtype=np.int8),
+                "sources": [],
+                "count": 0,
+                "next": 0
+            }
+            self._emb_by_task[task_id] = known
+        
+        row = known["next"]
+        capacity = known["matrix"].shape[0]
+        if row == capacity and capacity < self.MAX_KNOWN_PER_TASK:
+            capacity = min(capacity * 2, self.MAX_KNOWN_PER_TASK)
+            known["matrix"] = np.resize(known["matrix"], (capacity, embedding.shape[0]))
+        elif row == capacity:
+            row = 0
+        
+        known["matrix"][row] = embedding
+        if row < len(known["sources"]):
+            known["sources"][row] = source
+        else:
+            known["sources"].append(source)
+        known["count"] = max(known["count"], row + 1)
+        known["next"] = row + 1
     
     def _calculate_score(
         self,
@@ -401,7 +638,7 @@ class SolutionChecker:
 
 Решение кандидата:
 ```python
-{solution[:1500]}
+{solution}
 ```
 
 Оценка:
@@ -437,12 +674,12 @@ class SolutionChecker:
                 temperature=0.6
             )
             
-            feedback = self._extract_json_from_text(content)
+            feedback = extract_json_from_text(content)
             
             return feedback
             
-        except Exception as e:
-            print(f"Error generating feedback: {e}")
+        except Exception:
+            logger.warning("Error generating feedback", exc_info=True)
             return {
                 "text": f"Ваше решение оценено на {score}/100 баллов.",
                 "strengths": ["Решение работает"],
@@ -450,27 +687,4 @@ class SolutionChecker:
                 "recommendations": ["Продолжайте практиковаться"]
             }
     
-    def _extract_json_from_text(self, text: str) -> Any:
-        """Извлечение JSON из текста LLM"""
-        try:
-            return json.loads(text)
-        except:
-            pass
-        
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\}|\[.*?\])\s*```', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        json_match = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        return {}
-
 
@@ -1,14 +1,85 @@
 """
 Task Generator - Генерация персонализированных задач
 """
+from types import MappingProxyType
 from typing import Dict, Any, List, Optional
 from datetime import datetime
-import json
-import re
+import asyncio
+import copy
+import time
+import logging
 
+from ._json_utils import extract_json_from_text, parse_json_prefix, dumps_json
 from config.scibox import SciBoxClient
 
 
+logger = logging.getLogger(__name__)
+
+# Справочники для промпта генерации задачи (не меняются между вызовами)
+_DIFFICULTY_GUIDES = MappingProxyType({
+    "Junior": "базовые алгоритмы, работа с коллекциями, простая логика",
+    "Middle": "оптимизация, работа с БД, API дизайн, обработка ошибок",
+    "Senior": "системный дизайн, распределенные системы, производительность"
+})
+
+_TIME_LIMITS = MappingProxyType({
+    "Junior": "15-20 минут",
+    "Middle": "20-30 минут",
+    "Senior": "30-40 минут"
+})
+
+# Базовые задачи на случай, если LLM не сработал
+_FALLBACK_TASKS: Dict[str, Dict[str, Any]] = {
+    "Junior": {
+        "title": "Поиск дубликатов в массиве",
+        "description": "Напишите функцию, которая находит все дубликаты в массиве целых чисел.",
+        "requirements": [
+            "Функция принимает список целых чисел",
+            "Возвращает список уникальных дубликатов",
+            "Сложность не более O(n)"
+        ],
+        "estimated_time": 15,
+        "test_cases": {
+            "visible": [
+                {"input": [1, 2, 3, 1], "expected_output": [1], "description": "Один дубликат"}
+            ],
+            "hidden": [
+                {"input": [1, 1, 2, 2, 3], "expected_output": [1, 2], "description": "Несколько дубликатов"}
+            ]
+        }
+    },
+    "Middle": {
+        "title": "API эндпоинт для фильтрации данных",
+        "description": "Реализуйте FastAPI эндпоинт с фильтрацией, пагинацией и сортировкой.",
+        "requirements": [
+            "GET /items с query параметрами",
+            "Фильтрация по полям",
+            "Пагинация (offset, limit)",
+            "Обработка ошибок"
+        ],
+        "estimated_time": 25,
+        "test_cases": {
+            "visible": [],
+            "hidden": []
+        }
+    },
+    "Senior": {
+        "title": "Дизайн распределенного кеша",
+        "description": "Спроектируйте систему распределенного кеша с TTL и консистентным хешированием.",
+        "requirements": [
+            "Описать архитектуру",
+            "Выбрать алгоритм",
+            "Обосновать решения"
+        ],
+        "estimated_time": 35,
+        "test_cases": {
+            "visible": [],
+            "hidden": []
+        }
+    }
+}
+
+
 class TaskGenerator:
     """
     Генератор технических задач на основе:
@@ -55,7 +126,7 @@ class TaskGenerator:
             }
         """
         # Адаптация сложности на основе предыдущих результатов
-        adjusted_level = self._adjust_difficulty(
+        adjusted_level = self.next_level(
             candidate_level,
             previous_performance
         )
@@ -68,60 +139,82 @@ class TaskGenerator:
             resume_context
         )
         
+        tests_task: Optional[asyncio.Task] = None
+        
         try:
-            content = await self.client.async_chat_completion(
+            # Стримим ответ: как только title/description/requirements готовы,
+            # запускаем генерацию тестов, не дожидаясь остальных полей задачи
+            parts: List[str] = []
+            async for delta in self.client.async_chat_completion_stream(
                 messages=[{"role": "user", "content": prompt}],
                 model="qwen3-coder",
                 temperature=0.8,  # Креативность для уникальных задач
                 max_tokens=2000
-            )
+            ):
+                parts.append(delta)
+                if tests_task is None and "]" in delta:
+                    partial_task = parse_json_prefix("".join(parts), "requirements")
+                    if partial_task and partial_task.get("title"):
+                        tests_task = asyncio.create_task(
+                            self._generate_test_cases(partial_task, adjusted_level)
+                        )
             
-            task_data = self._extract_json_from_text(content)
+            task_data = extract_json_from_text("".join(parts))
             
-            # Генерация unit-тестов
-            task_data["test_cases"] = await self._generate_test_cases(
-                task_data,
-                adjusted_level
-            )
+            # Генерация unit-тестов (последовательно, если требования
+            # в стриме так и не закрылись)
+            if tests_task is not None:
+                task_data["test_cases"] = await tests_task
+            else:
+                task_data["test_cases"] = await self._generate_test_cases(
+                    task_data,
+                    adjusted_level
+                )
             
             # Добавление метаданных
-            task_data["task_id"] = f"task_{datetime.utcnow().timestamp()}"
-            task_data["generated_at"] = datetime.utcnow().isoformat()
+            generated_ts = time.time()
+            task_data["task_id"] = f"task_{generated_ts}"
+            task_data["generated_at"] = datetime.utcfromtimestamp(generated_ts).isoformat()
             task_data["difficulty"] = adjusted_level
             
             return task_data
             
-        except Exception as e:
-            print(f"Error generating task: {e}")
+        except Exception:
+            logger.warning("Error generating task", exc_info=True)
+            if tests_task is not None:
+                tests_task.cancel()
             return self._get_fallback_task(adjusted_level, focus_skills)
     
-    def _adjust_difficulty(
+    def next_level(
         self,
-        base_level: str,
-        previous_performance: Optional[Dict[str, Any]]
+        current_level: str,
+        performance: Optional[Dict[str, Any]]
     ) -> str:
         """
         Адаптация сложности на основе предыдущих результатов
         
+        Этот уровень generate_task использует для задачи (и пишет в ее
+        difficulty); по нему же вызывающий код сверяет спекулятивные задачи.
+        
         Логика:
         - Отличные результаты (score > 85) → повысить уровень
         - Плохие результаты (score < 50) → понизить уровень
         - Средние результаты → оставить текущий
         """
-        if not previous_performance:
-            return base_level
+        if not performance:
+            return current_level
         
-        score = previous_performance.get("score", 50)
+        score = performance.get("score", 50)
         
         level_order = ["Junior", "Middle", "Senior"]
-        current_index = level_order.index(base_level)
+        current_index = level_order.index(current_level)
         
         if score > 85 and current_index < len(level_order) - 1:
             return level_order[current_index + 1]
         elif score < 50 and current_index > 0:
             return level_order[current_index - 1]
         else:
-            return base_level
+            return current_level
     
     def _build_task_prompt(
         self,
@@ -141,25 +234,13 @@ class TaskGenerator:
             for p in projects:
                 context_str += f"- {p.get('name', 'Проект')}: {p.get('description', '')}\n"
         
-        difficulty_guides = {
-            "Junior": "базовые алгоритмы, работа с коллекциями, простая логика",
-            "Middle": "оптимизация, работа с БД, API дизайн, обработка ошибок",
-            "Senior": "системный дизайн, распределенные системы, производительность"
-        }
-        
-        time_limits = {
-            "Junior": "15-20 минут",
-            "Middle": "20-30 минут",
-            "Senior": "30-40 минут"
-        }
-        
         prompt = f"""Сгенерируй техническую задачу для собеседования.
 
 Уровень: {level}
 Фокус на технологиях: {', '.join(focus_skills)}
 Номер задачи: {task_number}
-Сложность: {difficulty_guides[level]}
-Время на решение: {time_limits[level]}
+Сложность: {_DIFFICULTY_GUIDES[level]}
+Время на решение: {_TIME_LIMITS[level]}
 {context_str}
 
 ВАЖНО:
@@ -212,7 +293,7 @@ class TaskGenerator:
 Задача: {task_data.get('title')}
 Описание: {task_data.get('description', '')[:500]}
 
-Требования: {json.dumps(task_data.get('requirements', []), ensure_ascii=False)}
+Требования: {dumps_json(task_data.get('requirements', []))}
 
 Создай тесты в формате JSON:
 {{
@@ -252,12 +333,12 @@ class TaskGenerator:
                 temperature=0.5
             )
             
-            tests = self._extract_json_from_text(content)
+            tests = extract_json_from_text(content)
             
             return tests
             
-        except Exception as e:
-            print(f"Error generating tests: {e}")
+        except Exception:
+            logger.warning("Error generating tests", exc_info=True)
             return {
                 "visible": [
                     {"input": "example", "expected_output": "result", "description": "Basic test"}
@@ -267,81 +348,9 @@ class TaskGenerator:
                 ]
             }
     
-    def _extract_json_from_text(self, text: str) -> Any:
-        """Извлечение JSON из текста LLM"""
-        try:
-            return json.loads(text)
-        except:
-            pass
-        
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\}|\[.*?\])\s*```', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        json_match = re.search(r'(\{.*?\}|\[.*?\])', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except:
-                pass
-        
-        return {}
-    
     def _get_fallback_task(self, level: str, skills: List[str]) -> Dict[str, Any]:
         """Базовая задача если LLM не сработал"""
-        tasks = {
-            "Junior": {
-                "title": "Поиск дубликатов в массиве",
-                "description": "Напишите функцию, которая находит все дубликаты в массиве целых чисел.",
-                "requirements": [
-                    "Функция принимает список целых чисел",
-                    "Возвращает список уникальных дубликатов",
-                    "Сложность не более O(n)"
-                ],
-                "estimated_time": 15,
-                "test_cases": {
-                    "visible": [
-                        {"input": [1, 2, 3, 1], "expected_output": [1], "description": "Один дубликат"}
-                    ],
-                    "hidden": [
-                        {"input": [1, 1, 2, 2, 3], "expected_output": [1, 2], "description": "Несколько дубликатов"}
-                    ]
-                }
-            },
-            "Middle": {
-                "title": "API эндпоинт для фильтрации данных",
-                "description": "Реализуйте FastAPI эндпоинт с фильтрацией, пагинацией и сортировкой.",
-                "requirements": [
-                    "GET /items с query параметрами",
-                    "Фильтрация по полям",
-                    "Пагинация (offset, limit)",
-                    "Обработка ошибок"
-                ],
-                "estimated_time": 25,
-                "test_cases": {
-                    "visible": [],
-                    "hidden": []
-                }
-            },
-            "Senior": {
-                "title": "Дизайн распределенного кеша",
-                "description": "Спроектируйте систему распределенного кеша с TTL и консистентным хешированием.",
-                "requirements": [
-                    "Описать архитектуру",
-                    "Выбрать алгоритм",
-                    "Обосновать решения"
-                ],
-                "estimated_time": 35,
-                "test_cases": {
-                    "visible": [],
-                    "hidden": []
-                }
-            }
-        }
-        
-        return tasks.get(level, tasks["Middle"])
+        # Копия: вызывающий код дописывает в задачу task_id и метаданные
+        return copy.deepcopy(_FALLBACK_TASKS.get(level, _FALLBACK_TASKS["Middle"]))
 
 
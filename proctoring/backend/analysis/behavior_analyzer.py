@@ -2,13 +2,34 @@
 Behavior Analyzer - Анализ поведения кандидата
 Детектирование подозрительных действий: DevTools, расширения, clipboard
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
 from datetime import datetime, timedelta
 from collections import defaultdict
+from bisect import bisect_left
+import logging
+
+import numpy as np
 
 from config.scibox import SciBoxClient
 
 
+logger = logging.getLogger(__name__)
+
+# Надбавка к скору clipboard_paste по размеру вставки: длина > порога[i] -> надбавка[i + 1]
+_PASTE_LENGTH_THRESHOLDS = (50, 100, 200, 500)
+_PASTE_LENGTH_BONUSES = (3, 8, 15, 25, 40)
+
+_SESSION_EVENTS_SQL = """
+    SELECT event_type,
+           (extract(epoch from timestamp) * 1000)::float8 AS timestamp_ms,
+           metadata
+    FROM proctoring_events
+    WHERE session_id = $1
+      AND timestamp >= $2
+    ORDER BY timestamp ASC
+"""
+
+
 class BehaviorAnalyzer:
     """
     Анализатор поведения для детектирования читерства
@@ -18,9 +39,27 @@ class BehaviorAnalyzer:
     - Анализ консолей (DevTools)
     """
     
+    # Бонус к финальному скору за обнаруженный паттерн по его severity
+    SEVERITY_SCORES = {
+        "critical": 30,
+        "high": 20,
+        "medium": 10
+    }
+    
     def __init__(self, scibox_client: SciBoxClient):
         self.client = scibox_client
         self.event_rules = self._init_event_rules()
+        # Плоская таблица для горячего цикла скоринга:
+        # event_type -> (base_score, multiplier, critical, dynamic_score)
+        self._rule_fast = {
+            event_type: (
+                rule["base_score"],
+                rule["multiplier"],
+                rule.get("critical", False),
+                rule.get("dynamic_score", False)
+            )
+            for event_type, rule in self.event_rules.items()
+        }
     
     def _init_event_rules(self) -> Dict[str, Dict[str, Any]]:
         """
@@ -93,7 +132,7 @@ class BehaviorAnalyzer:
         """
         # Получаем события из БД
         events = await self._get_session_events(session_id, time_window_minutes)
-        print('[DEBUG] Events:', events)
+        logger.debug("Events: %s", events)
         
         if not events:
             return {
@@ -103,28 +142,27 @@ class BehaviorAnalyzer:
                 "analysis_time": datetime.utcnow().isoformat()
             }
         
-        # DEBUG: Печатаем все события
-        print("[DEBUG] Events for analysis:")
-        for e in events:
-            print(f"  {e}")
+        # DEBUG: все события (форматируются, только если включен DEBUG)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Events for analysis:\n%s", "\n".join(f"  {e}" for e in events))
         # Анализ по правилам
         rule_analysis = self._analyze_by_rules(events)
-        print(f"[DEBUG] Rule analysis: {rule_analysis}")
-        # Группировка событий по типам
-        event_groups = self._group_events_by_type(events)
-        print(f"[DEBUG] Event groups: {event_groups}")
+        logger.debug("Rule analysis: %s", rule_analysis)
+        # Группировка событий по типам - уже посчитана при анализе по правилам
+        event_groups = rule_analysis["event_counts"]
+        logger.debug("Event groups: %s", event_groups)
         # Детектирование паттернов
-        patterns = self._detect_suspicious_patterns(events, event_groups)
-        print(f"[DEBUG] Patterns: {patterns}")
+        patterns, pattern_score = self._detect_suspicious_patterns(events, event_groups)
+        logger.debug("Patterns: %s", patterns)
         # Расчет финального скора
         final_score = self._calculate_final_score(
             rule_analysis["score"],
-            patterns
+            pattern_score
         )
-        print(f"[DEBUG] Final score: {final_score}")
+        logger.debug("Final score: %s", final_score)
         # Формирование списка подозрительных событий
         flagged_events = self._get_flagged_events(events, rule_analysis, patterns)
-        print(f"[DEBUG] Flagged events: {flagged_events}")
+        logger.debug("Flagged events: %s", flagged_events)
         return {
             "rule_based_score": rule_analysis["score"],
             "flagged_events": flagged_events,
@@ -142,43 +180,52 @@ class BehaviorAnalyzer:
         """Анализ событий по правилам"""
         total_score = 0
         event_counts = defaultdict(int)
-        critical_events = []
+        # Текущий множитель повторов по типу: multiplier ** (N - 1) без pow на каждое событие
+        running_multiplier = defaultdict(lambda: 1.0)
+        # Дальше нужны только число критичных событий и их типы
+        critical_count = 0
+        critical_types = set()
+        
+        # Горячий цикл для длинных сессий: поиск атрибутов выносим в локальные имена
+        get_rule = self._rule_fast.get
+        event_rules = self.event_rules
+        calculate_dynamic_score = self._calculate_dynamic_score
         
         for event in events:
-            event_type = event.get("event_type", "")
-            rule = self.event_rules.get(event_type)
+            event_type = event.get("event_type", "unknown")
+            
+            # Подсчет событий всех типов (заодно группировка для статистики)
+            event_counts[event_type] += 1
+            
+            rule = get_rule(event_type)
             
-            if not rule:
+            if rule is None:
                 continue
             
+            base_score, multiplier, critical, dynamic = rule
+            
             # Базовый балл
-            score = rule["base_score"]
+            score = base_score
             
             # Динамический расчет для некоторых событий
-            if rule.get("dynamic_score") and event.get("metadata"):
-                score = self._calculate_dynamic_score(event, rule)
+            if dynamic and event.get("metadata"):
+                score = calculate_dynamic_score(event, event_rules[event_type])
             
-            # Подсчет повторений
-            event_counts[event_type] += 1
-            
-            # Множитель для повторяющихся событий
-            if event_counts[event_type] > 1:
-                score *= rule["multiplier"] ** (event_counts[event_type] - 1)
+            # Множитель для повторяющихся событий (у первого события - 1.0)
+            score *= running_multiplier[event_type]
+            running_multiplier[event_type] *= multiplier
             
             total_score += score
             
             # Критичные события
-            if rule.get("critical"):
-                critical_events.append({
-                    "type": event_type,
-                    "timestamp": event.get("timestamp"),
-                    "score": score
-                })
+            if critical:
+                critical_count += 1
+                critical_types.add(event_type)
         
         return {
             "score": min(100, total_score),
-            "critical_count": len(critical_events),
-            "critical_events": critical_events,
+            "critical_count": critical_count,
+            "critical_types": critical_types,
             "event_counts": dict(event_counts)
         }
     
@@ -195,16 +242,10 @@ class BehaviorAnalyzer:
         if event.get("event_type") == "clipboard_paste":
             text_length = metadata.get("textLength", 0)
             
-            if text_length > 500:
-                return base_score + 40  # Очень большой фрагмент
-            elif text_length > 200:
-                return base_score + 25
-            elif text_length > 100:
-                return base_score + 15
-            elif text_length > 50:
-                return base_score + 8
-            else:
-                return base_score + 3
+            # bisect_left: длина, равная порогу, еще не переходит в следующий диапазон
+            return base_score + _PASTE_LENGTH_BONUSES[
+                bisect_left(_PASTE_LENGTH_THRESHOLDS, text_length)
+            ]
         
         # Для face_detection скор зависит от severity
         if event.get("event_type") == "face_detection":
@@ -235,47 +276,53 @@ class BehaviorAnalyzer:
         self,
         events: List[Dict[str, Any]],
         event_groups: Dict[str, int]
-    ) -> List[Dict[str, Any]]:
-        """Детектирование подозрительных паттернов"""
+    ) -> Tuple[List[Dict[str, Any]], float]:
+        """
+        Детектирование подозрительных паттернов
+        
+        Returns:
+            (паттерны для ответа, сумма баллов за паттерны по severity)
+        """
         patterns = []
+        pattern_score = 0
+        
+        # Один проход: раскладываем события по типам, face_detection - только
+        # счетчики по severity (сами события дальше не нужны)
+        buckets = defaultdict(list)
+        face_critical = 0
+        face_warning = 0
+        for e in events:
+            event_type = e.get("event_type")
+            buckets[event_type].append(e)
+            if event_type == "face_detection":
+                severity = e.get("metadata", {}).get("severity")
+                face_critical += severity == "critical"
+                face_warning += severity == "warning"
         
         # Паттерн 1: Быстрая последовательность clipboard_paste
-        paste_events = [
-            e for e in events
-            if e.get("event_type") == "clipboard_paste"
-        ]
+        paste_events = buckets["clipboard_paste"]
         
         if len(paste_events) > 3:
-            # Проверяем временные интервалы
-            recent_pastes = sorted(
-                paste_events,
-                key=lambda x: x.get("timestamp", 0),
-                reverse=True
-            )[:5]
+            # Проверяем временные интервалы между последними 5 вставками;
+            # события приходят из БД уже по возрастанию времени - берем хвост
+            recent_pastes = np.fromiter(
+                (e.get("timestamp", 0) for e in paste_events[-5:]),
+                dtype=np.float64
+            )
+            recent_count = len(recent_pastes)
             
-            if len(recent_pastes) >= 2:
-                time_diffs = []
-                for i in range(len(recent_pastes) - 1):
-                    diff = abs(
-                        recent_pastes[i].get("timestamp", 0) -
-                        recent_pastes[i+1].get("timestamp", 0)
-                    )
-                    time_diffs.append(diff)
-                
-                # Если несколько вставок за короткое время
-                if any(diff < 5000 for diff in time_diffs):  # Менее 5 секунд
-                    patterns.append({
-                        "type": "rapid_pasting",
-                        "severity": "high",
-                        "description": "Множественные быстрые вставки кода",
-                        "count": len(recent_pastes)
-                    })
+            # Если несколько вставок за короткое время
+            if (np.abs(np.diff(recent_pastes)) < 5000).any():  # Менее 5 секунд
+                patterns.append({
+                    "type": "rapid_pasting",
+                    "severity": "high",
+                    "description": "Множественные быстрые вставки кода",
+                    "count": recent_count
+                })
+                pattern_score += self.SEVERITY_SCORES["high"]
         
         # Паттерн 2: DevTools + Clipboard одновременно
-        devtools_events = [
-            e for e in events
-            if e.get("event_type") == "devtools_detected"
-        ]
+        devtools_events = buckets["devtools_detected"]
         
         if devtools_events and paste_events:
             patterns.append({
@@ -285,12 +332,10 @@ class BehaviorAnalyzer:
                 "devtools_count": len(devtools_events),
                 "paste_count": len(paste_events)
             })
+            pattern_score += self.SEVERITY_SCORES["critical"]
         
         # Паттерн 3: Расширение + большая вставка
-        extension_events = [
-            e for e in events
-            if e.get("event_type") == "extension_detected"
-        ]
+        extension_events = buckets["extension_detected"]
         
         if extension_events:
             large_pastes = [
@@ -306,12 +351,10 @@ class BehaviorAnalyzer:
                     "extension_count": len(extension_events),
                     "large_paste_count": len(large_pastes)
                 })
+                pattern_score += self.SEVERITY_SCORES["high"]
         
         # Паттерн 4: Множественные переключения вкладок
-        tab_switches = [
-            e for e in events
-            if e.get("event_type") == "tab_switch"
-        ]
+        tab_switches = buckets["tab_switch"]
         
         if len(tab_switches) > 5:
             patterns.append({
@@ -320,62 +363,37 @@ class BehaviorAnalyzer:
                 "description": "Чрезмерное переключение вкладок",
                 "count": len(tab_switches)
             })
+            pattern_score += self.SEVERITY_SCORES["medium"]
         
         # Паттерн 5: Детекция множественных лиц в кадре
-        face_detection_events = [
-            e for e in events
-            if e.get("event_type") == "face_detection"
-        ]
-        
-        critical_face_events = [
-            e for e in face_detection_events
-            if e.get("metadata", {}).get("severity") == "critical"
-        ]
-        
-        if len(critical_face_events) > 0:
+        if face_critical > 0:
             patterns.append({
                 "type": "multiple_people_detected",
                 "severity": "critical",
                 "description": "Обнаружено несколько человек в кадре",
-                "count": len(critical_face_events)
+                "count": face_critical
             })
+            pattern_score += self.SEVERITY_SCORES["critical"]
         
         # Паттерн 6: Частый выход из кадра
-        warning_face_events = [
-            e for e in face_detection_events
-            if e.get("metadata", {}).get("severity") == "warning"
-        ]
-        
-        if len(warning_face_events) > 5:
+        if face_warning > 5:
             patterns.append({
                 "type": "frequent_disappearance",
                 "severity": "high",
                 "description": "Участник часто выходит из кадра",
-                "count": len(warning_face_events)
+                "count": face_warning
             })
+            pattern_score += self.SEVERITY_SCORES["high"]
         
-        return patterns
+        return patterns, pattern_score
     
     def _calculate_final_score(
         self,
         rule_score: float,
-        patterns: List[Dict[str, Any]]
+        pattern_score: float
     ) -> float:
-        """Расчет финального скора с учетом паттернов"""
-        final_score = rule_score
-        
-        # Бонусы за паттерны
-        for pattern in patterns:
-            severity = pattern.get("severity", "medium")
-            
-            if severity == "critical":
-                final_score += 30
-            elif severity == "high":
-                final_score += 20
-            elif severity == "medium":
-                final_score += 10
-        
-        return final_score
+        """Расчет финального скора с учетом паттернов (баллы за них уже просуммированы)"""
+        return rule_score + pattern_score
     
     def _get_flagged_events(
         self,
@@ -387,8 +405,7 @@ class BehaviorAnalyzer:
         flagged = set()
         
         # Критичные события
-        for critical_event in rule_analysis.get("critical_events", []):
-            flagged.add(critical_event["type"])
+        flagged.update(rule_analysis.get("critical_types", ()))
         
         # События из паттернов
         for pattern in patterns:
@@ -416,38 +433,43 @@ class BehaviorAnalyzer:
     ) -> List[Dict[str, Any]]:
         """
         Получить события сессии из БД
-        
-        TODO: Реализовать реальный запрос к БД
         """
-        # Временная заглушка - должна быть реализация через asyncpg
         from proctoring.backend.database import get_db
         db = await get_db()
+        since = datetime.utcnow() - timedelta(minutes=time_window_minutes)
         
         try:
-            # Пример запроса (нужно адаптировать под используемую БД)
-            rows = await db.fetch(
-                """
-                SELECT event_type, timestamp, metadata
-                FROM proctoring_events
-                WHERE session_id = $1
-                  AND timestamp >= $2
-                ORDER BY timestamp ASC
-                """,
-                session_id,
-                datetime.utcnow() - timedelta(minutes=time_window_minutes)
-            )
-            
-            events = []
-            for row in rows:
-                events.append({
+            # Строки сразу превращаем в события - без промежуточного списка rows
+            return [
+                {
                     "event_type": row["event_type"],
-                    "timestamp": row["timestamp"].timestamp() * 1000,
+                    "timestamp": row["timestamp_ms"],
                     "metadata": row.get("metadata", {})
-                })
-            
-            return events
+                }
+                async for row in self._iter_event_rows(db, session_id, since)
+            ]
             
         except Exception as e:
             print(f"Error fetching session events: {e}")
             return []
-
+    
+    async def _iter_event_rows(
+        self,
+        db: Any,
+        session_id: str,
+        since: datetime
+    ) -> AsyncIterator[Any]:
+        """
+        Строки событий сессии по одной
+        
+        Из пула asyncpg читаем курсором (порциями), не буферизуя весь результат;
+        MockDatabase (режим без БД) умеет только fetch.
+        """
+        if hasattr(db, "acquire"):
+            async with db.acquire() as conn:
+                async with conn.transaction():
+                    async for row in conn.cursor(_SESSION_EVENTS_SQL, session_id, since):
+                        yield row
+        else:
+            for row in await db.fetch(_SESSION_EVENTS_SQL, session_id, since):
+                yield row
@@ -3,14 +3,31 @@ Code Analyzer - Анализ оригинальности кода
 Использует SciBox LLM для детектирования скопированного кода
 """
 import hashlib
-import json
+import re
 from typing import Dict, Any, Optional, List
 from datetime import datetime
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 import asyncio
 
+import orjson
+
 from config.scibox import SciBoxClient
 
 
+# Короче этого код не анализируем локально - статистике не на чем строиться
+_MIN_ANALYZED_CODE_LENGTH = 64
+
+# Тройные кавычки (docstrings) обоих видов - за один проход по коду
+_TRIPLE_QUOTE_RE = re.compile(r'"""|\'\'\'')
+
+
+@lru_cache(maxsize=4096)
+def _hash_code_cached(code: str) -> str:
+    """sha256 кода; при живом наборе один и тот же код приходит много раз"""
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
 class CodeAnalyzer:
     """
     Анализатор кода для проверки оригинальности
@@ -20,13 +37,23 @@ class CodeAnalyzer:
     - Система верификации оригинальности решения
     """
     
+    # Сколько анализов держать в кеше (LRU)
+    CODE_CACHE_SIZE = 1024
+    
+    # Сколько эмбеддингов кода держать в кеше (LRU)
+    EMBEDDING_CACHE_SIZE = 1024
+    
     def __init__(self, scibox_client: SciBoxClient):
         self.client = scibox_client
-        self.code_cache: Dict[str, Dict[str, Any]] = {}  # Кеш анализов
+        # Кеш анализов: code_hash -> сериализованный результат (компактнее dict)
+        self.code_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        # Эмбеддинги по code_hash - повторная отправка того же кода без запроса к bge-m3
+        self._embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
     
-    def hash_code(self, code: str) -> str:
+    @staticmethod
+    def hash_code(code: str) -> str:
         """Генерация хеша кода для быстрого сравнения"""
-        return hashlib.sha256(code.encode('utf-8')).hexdigest()
+        return _hash_code_cached(code)
     
     async def analyze_originality(
         self,
@@ -45,8 +72,10 @@ class CodeAnalyzer:
         code_hash = self.hash_code(code)
         
         # Проверяем кеш
-        if code_hash in self.code_cache:
-            cached_result = self.code_cache[code_hash]
+        cached = self.code_cache.get(code_hash)
+        if cached is not None:
+            self.code_cache.move_to_end(code_hash)
+            cached_result = orjson.loads(cached)
             cached_result["cached"] = True
             return cached_result
         
@@ -60,7 +89,7 @@ class CodeAnalyzer:
         )
         
         # Поиск похожих решений через эмбеддинги (если есть банк решений)
-        similar_solutions = await self._find_similar_solutions(code)
+        similar_solutions = await self._find_similar_solutions(code, code_hash)
         
         # Локальный анализ кода
         local_analysis = self._local_code_analysis(code, language)
@@ -97,7 +126,9 @@ class CodeAnalyzer:
                 )
         
         # Кешируем результат
-        self.code_cache[code_hash] = final_result
+        self.code_cache[code_hash] = orjson.dumps(final_result)
+        if len(self.code_cache) > self.CODE_CACHE_SIZE:
+            self.code_cache.popitem(last=False)
         
         return final_result
     
@@ -111,6 +142,8 @@ class CodeAnalyzer:
         Анализ оригинальности без привязки к сессии
         (для административных целей)
         """
+        code_hash = self.hash_code(code)
+        
         # Анализ через qwen3-coder
         originality_result = self.client.analyze_code_originality(
             code=code,
@@ -118,14 +151,14 @@ class CodeAnalyzer:
         )
         
         # Поиск похожих через эмбеддинги
-        similar_solutions = await self._find_similar_solutions(code)
+        similar_solutions = await self._find_similar_solutions(code, code_hash)
         
         return {
             "originality_score": originality_result["originality_score"],
             "suspicious_patterns": originality_result.get("suspicious_patterns", []),
             "explanation": originality_result.get("explanation", ""),
             "similar_solutions": similar_solutions,
-            "code_hash": self.hash_code(code),
+            "code_hash": code_hash,
             "analyzed_at": datetime.utcnow().isoformat()
         }
     
@@ -139,21 +172,35 @@ class CodeAnalyzer:
         - Структуру
         - Комментарии
         """
+        # Слишком короткий фрагмент: ни комментариев, ни идентификаторов для выводов
+        if len(code) < _MIN_ANALYZED_CODE_LENGTH:
+            return {
+                "is_suspicious": False,
+                "issues": [],
+                "unique_identifiers": 0,
+                "lines_count": len(code.splitlines())
+            }
+        
         suspicious = False
         issues = []
         
-        # Проверка на копи-паст паттерны
-        lines = code.split('\n')
-        
-        # Подозрительно: слишком много комментариев из одного источника
-        comment_style_count = {}
-        for line in lines:
+        # Проверка на копи-паст паттерны - один проход по строкам кода:
+        # - подозрительно: слишком много комментариев из одного источника
+        # - подозрительно: отсутствие личного стиля (мало уникальных идентификаторов)
+        comment_style_count = defaultdict(int)
+        unique_vars = set()
+        lines_count = 0
+        for line in code.splitlines():
+            lines_count += 1
             stripped = line.strip()
             if stripped.startswith('//') or stripped.startswith('#'):
                 # Анализируем стиль комментариев
                 if len(stripped) > 10:
-                    comment_style_count[stripped[:10]] = \
-                        comment_style_count.get(stripped[:10], 0) + 1
+                    comment_style_count[stripped[:10]] += 1
+            
+            for word in stripped.split():
+                if word.isalpha() and len(word) > 2:
+                    unique_vars.add(word)
         
         # Если много одинаковых комментариев - возможно копирование
         if comment_style_count:
@@ -167,17 +214,13 @@ class CodeAnalyzer:
             # Подозрительно: идеальное решение без ошибок для сложной задачи
             if "def" in code and "class" in code:
                 # Проверяем, нет ли слишком "книжного" стиля
-                if code.count('"""') > 2 or code.count("'''") > 2:
+                triple_quotes = _TRIPLE_QUOTE_RE.findall(code)
+                if triple_quotes.count('"""') > 2 or triple_quotes.count("'''") > 2:
                     # Много docstrings - возможно скопировано
                     pass
         
         # Проверка на отсутствие личного стиля
         # (слишком чистый код без характерных признаков)
-        unique_vars = set()
-        for word in code.split():
-            if word.isalpha() and len(word) > 2:
-                unique_vars.add(word)
-        
         if len(unique_vars) < 5:
             suspicious = True
             issues.append("Недостаточно уникальных идентификаторов")
@@ -186,10 +229,14 @@ class CodeAnalyzer:
             "is_suspicious": suspicious,
             "issues": issues,
             "unique_identifiers": len(unique_vars),
-            "lines_count": len(lines)
+            "lines_count": lines_count
         }
     
-    async def _find_similar_solutions(self, code: str) -> List[Dict[str, Any]]:
+    async def _find_similar_solutions(
+        self,
+        code: str,
+        code_hash: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
         """
         Поиск похожих решений через эмбеддинги
         
@@ -197,7 +244,7 @@ class CodeAnalyzer:
         """
         try:
             # Генерируем эмбеддинг для текущего кода
-            embedding = self.client.generate_embedding(code)
+            embedding = self._get_code_embedding(code, code_hash or self.hash_code(code))
             
             # Здесь должна быть логика поиска похожих решений в БД
             # Пока возвращаем пустой список (реализуется при наличии банка задач)
@@ -220,6 +267,21 @@ class CodeAnalyzer:
             print(f"Error finding similar solutions: {e}")
             return []
     
+    def _get_code_embedding(self, code: str, code_hash: str) -> List[float]:
+        """Эмбеддинг кода с кешем по уже посчитанному code_hash"""
+        embedding = self._embedding_cache.get(code_hash)
+        if embedding is not None:
+            self._embedding_cache.move_to_end(code_hash)
+            return embedding
+        
+        embedding = self.client.generate_embedding(code)
+        
+        self._embedding_cache[code_hash] = embedding
+        if len(self._embedding_cache) > self.EMBEDDING_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)
+        
+        return embedding
+    
     async def _get_task_description(self, task_id: str) -> str:
         """Получить описание задачи"""
         # TODO: Реализовать получение из БД
@@ -235,20 +297,18 @@ class CodeAnalyzer:
         Сравнение двух версий кода
         Полезно для детектирования больших вставок
         """
-        hash1 = self.hash_code(code1)
-        hash2 = self.hash_code(code2)
-        
-        # Если коды идентичны
-        if hash1 == hash2:
+        # Если коды идентичны (прямое сравнение строк дешевле двух sha256)
+        if code1 is code2 or code1 == code2:
             return {
                 "identical": True,
                 "similarity": 1.0,
                 "changes": 0
             }
         
-        # Подсчет различий (упрощенный алгоритм)
-        lines1 = set(code1.split('\n'))
-        lines2 = set(code2.split('\n'))
+        # Подсчет различий (упрощенный алгоритм); в множествах храним
+        # 64-битные хеши строк, а не сами строки
+        lines1 = {hash(line) for line in code1.splitlines()}
+        lines2 = {hash(line) for line in code2.splitlines()}
         
         common_lines = lines1 & lines2
         total_lines = len(lines1 | lines2)
@@ -1,12 +1,87 @@
 """
 Risk Scorer - Расчет и хранение скора риска читерства
 """
-from typing import Dict, Any, Optional, List
-from datetime import datetime
-import json
+from typing import Dict, Any, Mapping, Optional, List, Tuple
+from bisect import bisect_right
+from collections import OrderedDict
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+import orjson
 
 from config.scibox import SciBoxClient
 
+# Опциональный импорт redis: общий для всех воркеров кеш LLM-анализов
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    aioredis = None
+
+
+logger = logging.getLogger(__name__)
+
+# Уровни риска: скор >= порога -> следующий уровень
+_RISK_LEVEL_THRESHOLDS = (20, 40, 60, 80)
+_RISK_LEVELS = ("minimal", "low", "medium", "high", "critical")
+
+# Флаги из известного словаря хранятся битами в flagged_bits (BIGINT): OR вместо
+# array_append и проверки ANY; прочие (например, от LLM) - в flagged_events TEXT[].
+# Биты уже записаны в БД - новые флаги только дописывать в конец
+_FLAG_NAMES = (
+    "suspicious_code",
+    "devtools_detected",
+    "extension_detected",
+    "clipboard_paste",
+    "clipboard_copy",
+    "tab_switch",
+    "visibility_change",
+    "face_detection",
+)
+_FLAG_BITS = {name: 1 << bit for bit, name in enumerate(_FLAG_NAMES)}
+
+
+def _encode_flags(flagged_events: List[str]) -> Tuple[int, List[str]]:
+    """Список флагов -> (битовая маска известных, список остальных)"""
+    bits = 0
+    extra = []
+    for name in flagged_events:
+        bit = _FLAG_BITS.get(name)
+        if bit is None:
+            extra.append(name)
+        else:
+            bits |= bit
+    return bits, extra
+
+
+# SQL держим константами: asyncpg готовит (prepare) запросы и кеширует их
+# на соединении по тексту, так что повторные вызовы не парсятся заново
+_SELECT_SCORE_SQL = """
+    SELECT rule_based_score, llm_risk_score, final_score, 
+           flagged_bits, flagged_events, llm_recommendation, llm_reasoning, timestamp
+    FROM proctoring_scores
+    WHERE session_id = $1
+"""
+
+_FLAG_SUSPICIOUS_CODE_SQL = """
+    INSERT INTO proctoring_scores 
+    (session_id, timestamp, rule_based_score, final_score, flagged_bits)
+    VALUES ($1, NOW() AT TIME ZONE 'utc', LEAST(100, $2), LEAST(100, $2), $3)
+    ON CONFLICT (session_id) 
+    DO UPDATE SET
+        timestamp = EXCLUDED.timestamp,
+        rule_based_score = LEAST(100, proctoring_scores.rule_based_score + $2),
+        llm_risk_score = NULL,
+        final_score = LEAST(100, proctoring_scores.rule_based_score + $2),
+        flagged_bits = proctoring_scores.flagged_bits | $3
+    RETURNING rule_based_score, llm_risk_score, final_score,
+              flagged_bits, flagged_events, llm_recommendation, llm_reasoning, timestamp
+"""
+
 
 class RiskScorer:
     """
@@ -18,9 +93,17 @@ class RiskScorer:
     - Анализ оригинальности кода
     """
     
-    def __init__(self):
-        self.scibox_client = None  # Инициализируется при необходимости
-        self.llm_cache: Dict[str, Dict[str, Any]] = {}
+    # LRU кеш LLM-анализов поведения (ограничен по размеру и времени жизни)
+    LLM_CACHE_SIZE = 1024
+    LLM_CACHE_TTL = 3600  # секунд
+    
+    def __init__(self, scibox_client: Optional[SciBoxClient] = None):
+        # Приложение передает общий, уже прогретый клиент; иначе - лениво
+        self.scibox_client = scibox_client
+        # ключ -> (время записи, результат LLM)
+        self.llm_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Redis (если задан REDIS_URL) - кеш поверх локального, общий между воркерами
+        self._redis = None
     
     def _get_scibox_client(self) -> SciBoxClient:
         """Ленивая инициализация SciBox клиента"""
@@ -29,18 +112,38 @@ class RiskScorer:
             self.scibox_client = get_scibox_client()
         return self.scibox_client
     
+    def _get_redis(self):
+        """Ленивое подключение к Redis; None - работаем только с локальным кешем"""
+        if self._redis is None and REDIS_AVAILABLE:
+            redis_url = os.getenv("REDIS_URL")
+            if redis_url:
+                self._redis = aioredis.Redis.from_url(redis_url)
+        return self._redis
+    
+    def _remember_llm_result(self, cache_key: str, llm_result: Dict[str, Any]):
+        """Положить результат LLM в локальный LRU кеш"""
+        self.llm_cache[cache_key] = (time.monotonic(), llm_result)
+        if len(self.llm_cache) > self.LLM_CACHE_SIZE:
+            self.llm_cache.popitem(last=False)
+    
     async def update_session_score(
         self,
         session_id: str,
         rule_based_score: int,
         flagged_events: List[str],
-        llm_risk_score: Optional[int] = None
+        llm_risk_score: Optional[int] = None,
+        llm_recommendation: Optional[str] = None,
+        llm_reasoning: Optional[str] = None
     ):
         """
         Обновить скор риска для сессии
+        
+        Запись уходит в БД пачкой вместе с апдейтами других сессий
+        (см. queue_score_upsert); рекомендация LLM пишется тем же UPSERT
         """
-        from proctoring.backend.database import get_db
-        db = await get_db()
+        from proctoring.backend.database import queue_score_upsert
+        
+        flagged_bits, extra_flags = _encode_flags(flagged_events)
         
         # Расчет финального скора
         if llm_risk_score is not None:
@@ -49,65 +152,54 @@ class RiskScorer:
             final_score = rule_based_score
         
         try:
-            await db.execute(
-                """
-                INSERT INTO proctoring_scores 
-                (session_id, timestamp, rule_based_score, llm_risk_score, final_score, flagged_events)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                ON CONFLICT (session_id) 
-                DO UPDATE SET
-                    timestamp = $2,
-                    rule_based_score = $3,
-                    llm_risk_score = $4,
-                    final_score = $5,
-                    flagged_events = $6
-                """,
+            await queue_score_upsert(
                 session_id,
-                datetime.utcnow(),
                 rule_based_score,
                 llm_risk_score,
                 final_score,
-                flagged_events
+                flagged_bits,
+                extra_flags,
+                llm_recommendation,
+                llm_reasoning
             )
-        except Exception as e:
-            print(f"Error updating session score: {e}")
+        except Exception:
+            logger.exception("Error updating session score")
             # Если таблица не существует, создаем запись в памяти
             pass
     
-    async def get_session_score(self, session_id: str) -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def decode_flagged_events(row: Mapping[str, Any]) -> List[str]:
+        """flagged_bits + flagged_events строки скора -> список флагов"""
+        bits = row["flagged_bits"] or 0
+        flags = [name for name in _FLAG_NAMES if bits & _FLAG_BITS[name]]
+        # В строках, записанных до flagged_bits, известные флаги лежат в массиве
+        for name in row["flagged_events"] or ():
+            if name not in flags:
+                flags.append(name)
+        return flags
+    
+    async def get_session_score(self, session_id: str) -> Optional[Mapping[str, Any]]:
         """
         Получить текущий скор риска для сессии
+        
+        Возвращает строку БД как есть (asyncpg.Record: доступ по имени колонки
+        и .get) - без копирования в dict; в dict ее превращает слой ответа.
+        Флаги из нее - через decode_flagged_events
         """
-        from proctoring.backend.database import get_db
+        from proctoring.backend.database import get_db, flush_score_upserts
         db = await get_db()
         
         try:
-            row = await db.fetchrow(
-                """
-                SELECT rule_based_score, llm_risk_score, final_score, 
-                       flagged_events, llm_recommendation, llm_reasoning
-                FROM proctoring_scores
-                WHERE session_id = $1
-                ORDER BY timestamp DESC
-                LIMIT 1
-                """,
+            # Сначала дописываем отложенный апдейт этой сессии, если он есть
+            await flush_score_upserts(session_id)
+            
+            return await db.fetchrow(
+                _SELECT_SCORE_SQL,
                 session_id
             )
             
-            if not row:
-                return None
-            
-            return {
-                "rule_based_score": row["rule_based_score"],
-                "llm_risk_score": row.get("llm_risk_score"),
-                "final_score": row["final_score"],
-                "flagged_events": row.get("flagged_events", []),
-                "llm_recommendation": row.get("llm_recommendation"),
-                "llm_reasoning": row.get("llm_reasoning")
-            }
-            
-        except Exception as e:
-            print(f"Error getting session score: {e}")
+        except Exception:
+            logger.exception("Error getting session score")
             return None
     
     async def flag_suspicious_code(
@@ -115,33 +207,35 @@ class RiskScorer:
         session_id: str,
         originality_score: int,
         suspicious_patterns: List[str]
-    ):
+    ) -> Optional[Mapping[str, Any]]:
         """
         Пометка подозрительного кода и обновление скора
-        """
-        current_score = await self.get_session_score(session_id)
         
-        if current_score:
-            rule_based_score = current_score.get("rule_based_score", 0)
-        else:
-            rule_based_score = 0
+        Одним атомарным UPSERT: штраф прибавляется к скору и 'suspicious_code'
+        добавляется во flagged_events на стороне БД - без SELECT перед записью
+        и без потери апдейта при параллельных снимках кода
         
-        # Если оригинальность низкая, увеличиваем риск
-        if originality_score < 50:
-            penalty = 50 - originality_score  # Штраф 0-50 баллов
-            rule_based_score += penalty
-            rule_based_score = min(100, rule_based_score)
+        Returns:
+            Скор сессии после записи (из RETURNING) или None при ошибке
+        """
+        from proctoring.backend.database import get_db, flush_score_upserts
+        db = await get_db()
         
-        # Обновляем скор
-        flagged_events = current_score.get("flagged_events", []) if current_score else []
-        if "suspicious_code" not in flagged_events:
-            flagged_events.append("suspicious_code")
+        # Если оригинальность низкая, увеличиваем риск (штраф 0-50 баллов)
+        penalty = max(0, 50 - originality_score)
         
-        await self.update_session_score(
-            session_id=session_id,
-            rule_based_score=rule_based_score,
-            flagged_events=flagged_events
-        )
+        try:
+            # Отложенный апдейт этой сессии должен лечь раньше, иначе он затрет флаг
+            await flush_score_upserts(session_id)
+            return await db.fetchrow(
+                _FLAG_SUSPICIOUS_CODE_SQL,
+                session_id,
+                penalty,
+                _FLAG_BITS["suspicious_code"]
+            )
+        except Exception:
+            logger.exception("Error flagging suspicious code")
+            return None
     
     async def request_llm_analysis(
         self,
@@ -156,48 +250,66 @@ class RiskScorer:
         
         Использует qwen3-awq для анализа поведения
         """
-        # Проверяем кеш
-        cache_key = f"{session_id}_{len(events)}_{elapsed_time}"
-        if cache_key in self.llm_cache:
-            return self.llm_cache[cache_key]
+        # Проверяем кеш: ключ - хеш всего, что попадает в промпт (а не только
+        # число событий), плюс session_id - промах должен записать скор сессии
+        cache_key = hashlib.blake2b(
+            orjson.dumps(
+                [session_id, elapsed_time, candidate_level, task_description, events],
+                option=orjson.OPT_SORT_KEYS
+            ),
+            digest_size=16
+        ).hexdigest()
+        cached = self.llm_cache.get(cache_key)
+        if cached is not None:
+            inserted_at, cached_result = cached
+            if time.monotonic() - inserted_at < self.LLM_CACHE_TTL:
+                self.llm_cache.move_to_end(cache_key)
+                return cached_result
+            del self.llm_cache[cache_key]
+        
+        # Другой воркер мог уже получить этот анализ
+        redis_client = self._get_redis()
+        redis_key = f"proctoring:llm_analysis:{cache_key}"
+        if redis_client is not None:
+            try:
+                shared = await redis_client.get(redis_key)
+            except Exception:
+                logger.warning("Error reading LLM analysis from Redis", exc_info=True)
+                shared = None
+            if shared is not None:
+                llm_result = orjson.loads(shared)
+                self._remember_llm_result(cache_key, llm_result)
+                return llm_result
         
         client = self._get_scibox_client()
         
-        # Анализ через LLM
-        llm_result = client.analyze_proctoring_behavior(
+        # Анализ через LLM: клиент синхронный, поэтому в пуле потоков -
+        # event loop тем временем обслуживает другие запросы
+        llm_result = await asyncio.to_thread(
+            client.analyze_proctoring_behavior,
             events=events,
             task_description=task_description,
             elapsed_time=elapsed_time,
             candidate_level=candidate_level
         )
         
-        # Сохранение результата
+        # Сохранение результата вместе с рекомендацией - одним UPSERT
         await self.update_session_score(
             session_id=session_id,
             rule_based_score=0,  # Обновляется отдельно
             flagged_events=llm_result.get("flagged_events", []),
-            llm_risk_score=llm_result.get("risk_score")
+            llm_risk_score=llm_result.get("risk_score"),
+            llm_recommendation=llm_result.get("recommendation"),
+            llm_reasoning=llm_result.get("reasoning")
         )
         
-        # Обновление с рекомендацией
-        from proctoring.backend.database import get_db
-        db = await get_db()
-        try:
-            await db.execute(
-                """
-                UPDATE proctoring_scores
-                SET llm_recommendation = $1, llm_reasoning = $2
-                WHERE session_id = $3
-                """,
-                llm_result.get("recommendation"),
-                llm_result.get("reasoning"),
-                session_id
-            )
-        except Exception as e:
-            print(f"Error updating LLM recommendation: {e}")
-        
-        # Кеширование
-        self.llm_cache[cache_key] = llm_result
+        # Кеширование (локально и для остальных воркеров)
+        self._remember_llm_result(cache_key, llm_result)
+        if redis_client is not None:
+            try:
+                await redis_client.setex(redis_key, self.LLM_CACHE_TTL, orjson.dumps(llm_result))
+            except Exception:
+                logger.warning("Error writing LLM analysis to Redis", exc_info=True)
         
         return llm_result
     
@@ -205,16 +317,7 @@ class RiskScorer:
         """
         Определить уровень риска по скору
         """
-        if score >= 80:
-            return "critical"
-        elif score >= 60:
-            return "high"
-        elif score >= 40:
-            return "medium"
-        elif score >= 20:
-            return "low"
-        else:
-            return "minimal"
+        return _RISK_LEVELS[bisect_right(_RISK_LEVEL_THRESHOLDS, score)]
     
     async def get_session_summary(self, session_id: str) -> Dict[str, Any]:
         """
@@ -235,12 +338,13 @@ class RiskScorer:
         return {
             "session_id": session_id,
             "rule_based_score": score_data["rule_based_score"],
-            "llm_risk_score": score_data.get("llm_risk_score"),
+            "llm_risk_score": score_data["llm_risk_score"],
             "final_score": final_score,
             "risk_level": risk_level,
-            "flagged_events": score_data.get("flagged_events", []),
-            "llm_recommendation": score_data.get("llm_recommendation"),
-            "llm_reasoning": score_data.get("llm_reasoning"),
-            "timestamp": datetime.utcnow().isoformat()
+            "flagged_events": self.decode_flagged_events(score_data),
+            "llm_recommendation": score_data["llm_recommendation"],
+            "llm_reasoning": score_data["llm_reasoning"],
+            # Время последней записи скора (ставит БД), а не момент запроса
+            "timestamp": score_data["timestamp"].isoformat()
         }
 
@@ -3,6 +3,8 @@ FastAPI Backend для прокторинг-системы
 """
 import os
 import sys
+import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 # Добавляем корневую директорию в путь
@@ -11,12 +13,13 @@ sys.path.insert(0, str(root_dir))
 
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import FileResponse, ORJSONResponse
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 import uuid
 import aiofiles
+import orjson
 from dotenv import load_dotenv
 
 from config.scibox import get_scibox_client
@@ -24,15 +27,36 @@ from interviewer.interview_session import InterviewSession
 from proctoring.backend.analysis.code_analyzer import CodeAnalyzer
 from proctoring.backend.analysis.behavior_analyzer import BehaviorAnalyzer
 from proctoring.backend.analysis.risk_scorer import RiskScorer
-from proctoring.backend.database import get_db, init_db
+from proctoring.backend.database import get_db, init_db, close_db
 
 # Загрузка переменных окружения
 load_dotenv()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Инициализация при запуске и очистка при завершении"""
+    await init_db()
+    print("✅ Database initialized")
+    app.state.scibox = scibox_client
+    # TLS/HTTP2 до SciBox поднимаем в фоне, чтобы первый LLM-анализ не платил
+    # за соединение; старт сервиса при этом не ждет API
+    app.state.scibox_warm_up = asyncio.create_task(scibox_client.warm_up())
+    print("✅ Proctoring API started")
+    yield
+    app.state.scibox_warm_up.cancel()
+    # Закрываем HTTP-соединения к SciBox и пул БД внутри того же event loop
+    await scibox_client.aclose()
+    await close_db()
+    print("🛑 Proctoring API stopped")
+
+
 app = FastAPI(
     title="VibeCode Jam Proctoring API",
     description="API для системы защиты от читерства",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -48,7 +72,7 @@ app.add_middleware(
 scibox_client = get_scibox_client()
 code_analyzer = CodeAnalyzer(scibox_client)
 behavior_analyzer = BehaviorAnalyzer(scibox_client)
-risk_scorer = RiskScorer()
+risk_scorer = RiskScorer(scibox_client)
 interview_session = InterviewSession(scibox_client)
 
 # WebSocket соединения
@@ -89,6 +113,11 @@ class Heartbeat(BaseModel):
     timestamp: int
 
 
+class WebSocketMessage(BaseModel):
+    # Клиент может прислать любой JSON объект, в т.ч. без type
+    type: Optional[str] = None
+
+
 # Interviewer API models
 class StartInterviewRequest(BaseModel):
     resumeText: str
@@ -103,20 +132,6 @@ class SubmitSolutionRequest(BaseModel):
     timeSpent: int = 0  # seconds
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Инициализация при запуске"""
-    await init_db()
-    print("✅ Database initialized")
-    print("✅ Proctoring API started")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Очистка при завершении"""
-    print("🛑 Proctoring API stopped")
-
-
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -160,10 +175,10 @@ async def api_submit_solution(body: SubmitSolutionRequest):
 @app.get("/health")
 async def health():
     """Health check"""
-    return {
+    return ORJSONResponse({
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat()
-    }
+    })
 
 
 @app.post("/api/proctoring/events")
@@ -182,6 +197,8 @@ async def receive_events(batch: EventsBatch):
         # Сохранение событий в БД
         # Примечание: тестовые события могут иметь "старые" timestamps (например, 1000000000000),
         # поэтому используем текущее время, чтобы они попадали в окно анализа.
+        # Одно время приема на весь батч вместо utcnow() на каждое событие.
+        received_at = datetime.utcnow()
         for event in batch.events:
             await db.execute(
                 """
@@ -191,7 +208,7 @@ async def receive_events(batch: EventsBatch):
                 """,
                 batch.sessionId,
                 event.type,
-                datetime.utcnow(),
+                received_at,
                 (event.metadata or {})
             )
         
@@ -218,12 +235,13 @@ async def receive_events(batch: EventsBatch):
                 }
             )
         
-        return {
+        # Готовый ORJSONResponse: FastAPI не прогоняет dict через jsonable_encoder
+        return ORJSONResponse({
             "status": "ok",
             "events_received": len(batch.events),
             "current_risk_score": risk_result["final_score"],
             "flagged_events": risk_result["flagged_events"]
-        }
+        })
         
     except Exception as e:
         print(f"Error processing events: {e}")
@@ -299,24 +317,24 @@ async def get_risk_score(session_id: str):
         result = await risk_scorer.get_session_score(session_id)
         
         if not result:
-            return {
+            return ORJSONResponse({
                 "session_id": session_id,
                 "rule_based_score": 0,
                 "llm_risk_score": None,
                 "final_score": 0,
                 "flagged_events": [],
                 "status": "no_data"
-            }
+            })
         
-        return {
+        return ORJSONResponse({
             "session_id": session_id,
             "rule_based_score": result["rule_based_score"],
             "llm_risk_score": result.get("llm_risk_score"),
             "final_score": result["final_score"],
-            "flagged_events": result.get("flagged_events", []),
+            "flagged_events": risk_scorer.decode_flagged_events(result),
             "llm_recommendation": result.get("llm_recommendation"),
             "status": "monitoring"
-        }
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -348,7 +366,7 @@ async def analyze_code(
 async def receive_heartbeat(heartbeat: Heartbeat):
     """Heartbeat от клиента"""
     # Можно обновить время последней активности
-    return {"status": "ok"}
+    return ORJSONResponse({"status": "ok"})
 
 
 @app.post("/api/proctoring/screenshot")
@@ -389,14 +407,15 @@ async def upload_screenshot(
         }
 
         # Добавляем к событиям прокторинга сессии
-        if sessionId not in proctoring_sessions:
-            proctoring_sessions[sessionId] = {
+        session = proctoring_sessions.get(sessionId)
+        if session is None:
+            session = proctoring_sessions[sessionId] = {
                 "events": [],
                 "code_snapshots": [],
                 "screenshots": []
             }
         
-        proctoring_sessions[sessionId]["screenshots"].append(metadata)
+        session["screenshots"].append(metadata)
 
         print(f"Screenshot saved: {filepath} ({len(content)} bytes)")
 
@@ -416,10 +435,11 @@ async def get_session_screenshots(session_id: str):
     """
     Получить список скриншотов для сессии
     """
-    if session_id not in proctoring_sessions:
+    session = proctoring_sessions.get(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    screenshots = proctoring_sessions[session_id].get("screenshots", [])
+    screenshots = session.get("screenshots", [])
     
     return {
         "sessionId": session_id,
@@ -454,11 +474,14 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
     try:
         while True:
             data = await websocket.receive_text()
-            import json
-            message = json.loads(data)
+            try:
+                message = WebSocketMessage.model_validate_json(data)
+            except ValidationError:
+                # Неизвестный формат кадра - пропускаем, соединение не рвем
+                continue
             
-            if message.get("type") == "ping":
-                await websocket.send_json({"type": "pong"})
+            if message.type == "ping":
+                await websocket.send_text(orjson.dumps({"type": "pong"}).decode())
                 
     except WebSocketDisconnect:
         del active_connections[session_id]
@@ -472,7 +495,9 @@ async def send_websocket_message(session_id: str, message: Dict[str, Any]):
     """Отправить сообщение через WebSocket"""
     if session_id in active_connections:
         try:
-            await active_connections[session_id].send_json(message)
+            # orjson вместо json.dumps внутри send_json; отправляем текстовым
+            # фреймом, т.к. клиент делает JSON.parse(event.data)
+            await active_connections[session_id].send_text(orjson.dumps(message).decode())
         except Exception as e:
             print(f"Error sending WebSocket message: {e}")
 
@@ -2,7 +2,8 @@
 Risk Scoring System
 Вычисляет риск читерства на основе событий прокторинга
 """
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
+from collections import Counter, OrderedDict
 from datetime import datetime
 import asyncio
 from config.scibox import get_scibox_client
@@ -11,8 +12,18 @@ from config.scibox import get_scibox_client
 class RiskScorer:
     """Система оценки риска читерства"""
     
+    # LRU по сессиям: окончания сессии сервер не видит, поэтому
+    # состояние давно неактивных сессий вытесняется
+    SESSION_CACHE_SIZE = 1024
+    
     def __init__(self):
         self.scibox_client = get_scibox_client()
+        # Последний результат по сессии: (кол-во событий, результат).
+        # События только дописываются, поэтому совпадение длины = нет изменений
+        self._risk_cache: "OrderedDict[str, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        # Накопленное состояние правил по сессии, чтобы обрабатывать только новые события
+        # (вытесненная сессия просто пересчитывается с нуля)
+        self._rule_state: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
         self.event_weights = {
             # Критичные события
             "devtools_detected": 30,
@@ -51,11 +62,19 @@ class RiskScorer:
         Returns:
             Словарь с оценкой риска
         """
-        # Правила-основанная оценка (быстрая)
-        rule_based_score = self._rule_based_scoring(events)
+        # Новых событий не было - отдаем ранее посчитанный результат
+        cached = self._risk_cache.get(session_id)
+        if cached is not None and cached[0] == len(events):
+            self._risk_cache.move_to_end(session_id)
+            # Вызывающий код может менять результат - отдаем копию со свежим временем
+            return {
+                **cached[1],
+                "flagged_events": list(cached[1]["flagged_events"]),
+                "timestamp": datetime.now().isoformat()
+            }
         
-        # Флаги подозрительных событий
-        flagged_events = self._get_flagged_events(events)
+        # Правила-основанная оценка и флаги (инкрементально, только по новым событиям)
+        rule_based_score, flagged_events = self._incremental_rule_scoring(session_id, events)
         
         # Финальный скор (пока только правило-основанный)
         final_score = rule_based_score
@@ -73,7 +92,7 @@ class RiskScorer:
             except Exception as e:
                 print(f"[RiskScorer] LLM analysis error: {e}")
         
-        return {
+        result = {
             "session_id": session_id,
             "rule_based_score": rule_based_score,
             "llm_risk_score": llm_risk_score,
@@ -82,15 +101,35 @@ class RiskScorer:
             "events_count": len(events),
             "timestamp": datetime.now().isoformat()
         }
+        self._risk_cache[session_id] = (len(events), dict(result, flagged_events=list(flagged_events)))
+        self._risk_cache.move_to_end(session_id)
+        if len(self._risk_cache) > self.SESSION_CACHE_SIZE:
+            self._risk_cache.popitem(last=False)
+        
+        return result
     
-    def _rule_based_scoring(self, events: List[Dict[str, Any]]) -> int:
-        """Оценка на основе правил"""
-        total_score = 0
-        event_counts = {}
+    def _incremental_rule_scoring(
+        self,
+        session_id: str,
+        events: List[Dict[str, Any]]
+    ) -> Tuple[int, List[str]]:
+        """Оценка на основе правил и флаги с учетом только новых событий"""
+        state = self._rule_state.get(session_id)
+        if state is None or state["processed"] > len(events):
+            # Первая оценка или список событий был заменен - считаем с нуля
+            state = {"processed": 0, "total_score": 0, "event_counts": Counter(), "flagged": set()}
+            self._rule_state[session_id] = state
+            if len(self._rule_state) > self.SESSION_CACHE_SIZE:
+                self._rule_state.popitem(last=False)
+        else:
+            self._rule_state.move_to_end(session_id)
+        
+        event_counts = state["event_counts"]
+        flagged = state["flagged"]
         
-        for event in events:
+        for event in events[state["processed"]:]:
             event_type = event.get("type", "unknown")
-            event_counts[event_type] = event_counts.get(event_type, 0) + 1
+            event_counts[event_type] += 1
             
             # Базовый вес события
             base_weight = self.event_weights.get(event_type, 0)
@@ -103,46 +142,32 @@ class RiskScorer:
                     base_weight += 20  # Большая вставка
                 elif text_length > 200:
                     base_weight += 10  # Средняя вставка
+                
+                # Большие вставки кода
+                if text_length > 200:
+                    flagged.add("large_code_paste")
             
-            elif event_type == "devtools_detected":
-                # DevTools - всегда критично
-                base_weight = 30
+            elif event_type in ["devtools_detected", "extension_detected"]:
+                # Критичные события всегда флагятся
+                flagged.add(event_type)
+                if event_type == "devtools_detected":
+                    # DevTools - всегда критично
+                    base_weight = 30
             
             elif event_type == "tab_switch" or event_type == "visibility_hidden":
                 # Множественные переключения подозрительны
-                count = event_counts.get(event_type, 0)
+                count = event_counts[event_type]
                 if count > 5:
                     base_weight += 5 * (count - 5)  # Дополнительный штраф
-            
-            total_score += base_weight
-        
-        # Ограничиваем максимальный скор
-        return min(100, total_score)
-    
-    def _get_flagged_events(self, events: List[Dict[str, Any]]) -> List[str]:
-        """Получить список типов подозрительных событий"""
-        flagged = set()
-        
-        for event in events:
-            event_type = event.get("type", "")
-            
-            # Критичные события всегда флагятся
-            if event_type in ["devtools_detected", "extension_detected"]:
-                flagged.add(event_type)
-            
-            # Большие вставки кода
-            if event_type == "clipboard_paste":
-                text_length = event.get("textLength", 0)
-                if text_length > 200:
-                    flagged.add("large_code_paste")
-            
-            # Множественные переключения вкладок
-            if event_type in ["tab_switch", "visibility_hidden"]:
-                count = sum(1 for e in events if e.get("type") == event_type)
                 if count > 3:
                     flagged.add("excessive_tab_switching")
+            
+            state["total_score"] += base_weight
+        
+        state["processed"] = len(events)
         
-        return list(flagged)
+        # Ограничиваем максимальный скор
+        return min(100, state["total_score"]), list(flagged)
     
     async def _llm_analysis(
         self,
@@ -3,10 +3,11 @@ FastAPI server for proctoring system
 """
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Dict, Any, Optional
 import asyncio
-import json
+import orjson
 from datetime import datetime
 
 import sys
@@ -20,7 +21,11 @@ from proctoring.risk_scorer import RiskScorer
 from proctoring.models import ProctoringEvent, CodeSnapshot, ProctoringScore
 from config.scibox import get_scibox_client
 
-app = FastAPI(title="Proctoring API", version="1.0.0")
+app = FastAPI(
+    title="Proctoring API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -61,6 +66,13 @@ class HeartbeatRequest(BaseModel):
     timestamp: int
 
 
+class WebSocketMessage(BaseModel):
+    # Клиент может прислать любой JSON объект, в т.ч. без type
+    type: Optional[str] = None
+    sessionId: Optional[str] = None
+    event: Dict[str, Any] = {}
+
+
 @app.post("/api/proctoring/events")
 async def receive_events(request: EventRequest):
     """Прием событий прокторинга от клиента"""
@@ -68,23 +80,22 @@ async def receive_events(request: EventRequest):
         session_id = request.sessionId
         
         # Сохраняем события
-        if session_id not in events_storage:
-            events_storage[session_id] = []
-        events_storage[session_id].extend(request.events)
+        session_events = events_storage.setdefault(session_id, [])
+        session_events.extend(request.events)
         
         # Обновляем последнюю активность
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {
+        session_info = active_sessions.get(session_id)
+        if session_info is None:
+            session_info = active_sessions[session_id] = {
                 "sessionId": session_id,
-                "startTime": datetime.now().isoformat(),
-                "lastActivity": datetime.now().isoformat()
+                "startTime": datetime.now().isoformat()
             }
-        active_sessions[session_id]["lastActivity"] = datetime.now().isoformat()
+        session_info["lastActivity"] = datetime.now().isoformat()
         
         # Вычисляем риск на основе событий
         risk_result = await risk_scorer.calculate_risk(
             session_id=session_id,
-            events=events_storage[session_id]
+            events=session_events
         )
         
         # Сохраняем скор
@@ -116,9 +127,7 @@ async def receive_code_snapshot(request: CodeSnapshotRequest):
             "timestamp": request.timestamp
         }
         
-        if session_id not in code_snapshots:
-            code_snapshots[session_id] = []
-        code_snapshots[session_id].append(snapshot)
+        code_snapshots.setdefault(session_id, []).append(snapshot)
         
         # Анализируем оригинальность кода
         # В фоне, чтобы не блокировать ответ
@@ -206,13 +215,14 @@ async def heartbeat(request: HeartbeatRequest):
     try:
         session_id = request.sessionId
         
-        if session_id not in active_sessions:
-            active_sessions[session_id] = {
+        session_info = active_sessions.get(session_id)
+        if session_info is None:
+            session_info = active_sessions[session_id] = {
                 "sessionId": session_id,
                 "startTime": datetime.now().isoformat()
             }
         
-        active_sessions[session_id]["lastHeartbeat"] = datetime.now().isoformat()
+        session_info["lastHeartbeat"] = datetime.now().isoformat()
         
         return {"status": "ok"}
         
@@ -229,41 +239,45 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
         while True:
             # Получаем события от клиента
             data = await websocket.receive_text()
-            event = json.loads(data)
+            # Один проход pydantic (jiter) вместо json.loads + dict.get
+            try:
+                message = WebSocketMessage.model_validate_json(data)
+            except ValidationError:
+                # Неизвестный формат кадра - пропускаем, соединение не рвем
+                continue
             
             # Обрабатываем событие
-            if event.get("type") == "event":
-                session_id = event.get("sessionId", session_id)
-                proctoring_event = event.get("event", {})
+            if message.type == "event":
+                session_id = message.sessionId or session_id
+                proctoring_event = message.event
                 
                 # Сохраняем событие
-                if session_id not in events_storage:
-                    events_storage[session_id] = []
-                events_storage[session_id].append(proctoring_event)
+                session_events = events_storage.setdefault(session_id, [])
+                session_events.append(proctoring_event)
                 
                 # Вычисляем риск
                 risk_result = await risk_scorer.calculate_risk(
                     session_id=session_id,
-                    events=events_storage[session_id]
+                    events=session_events
                 )
                 
                 # Отправляем обновление риска клиенту
-                await websocket.send_json({
+                await websocket.send_text(orjson.dumps({
                     "type": "risk_update",
                     "risk_score": risk_result.get("final_score", 0),
                     "flagged_events": risk_result.get("flagged_events", [])
-                })
+                }).decode())
                 
                 # Если высокий риск - отправляем предупреждение
                 if risk_result.get("final_score", 0) > 70:
-                    await websocket.send_json({
+                    await websocket.send_text(orjson.dumps({
                         "type": "warning",
                         "message": "Обнаружена подозрительная активность",
                         "risk_level": "high"
-                    })
+                    }).decode())
             
-            elif event.get("type") == "ping":
-                await websocket.send_json({"type": "pong"})
+            elif message.type == "ping":
+                await websocket.send_text(orjson.dumps({"type": "pong"}).decode())
                 
     except WebSocketDisconnect:
         print(f"[WebSocket] Client disconnected: {session_id}")